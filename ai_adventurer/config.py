@@ -6,6 +6,9 @@ Only using simple INI files by now.
 """
 
 import configparser
+import os
+import stat
+import tempfile
 
 
 default_configfile = "config.ini"
@@ -13,8 +16,15 @@ default_secretsfile = "secrets.ini"
 
 default_config = {
     "DEFAULT": {
-        # See ai_adventurer/nlp.py for available models
+        # See ai_adventurer/nlp.py for available models. Could be a comma
+        # separated list, to fall back to the next when one fails.
         "nlp_model": "gemini-1.5-flash",
+        # Directory for caching NLP responses between sessions. Empty to
+        # disable. Needs the diskcache package.
+        "nlp_cache_dir": "",
+        # Generate the next lines in the background, before they are asked
+        # for. Costs extra prompts when the story is changed in between.
+        "nlp_prefetch": "false",
     },
 }
 
@@ -49,16 +59,46 @@ def load_config(config_file=None, args=None):
     return config
 
 
+def _write(config, filename, mode=0o644):
+    """Write the config to a temporary file, then replace the old file.
+
+    The replace is atomic, so the old file is kept as is if the writing
+    fails halfway.
+
+    @param mode:
+        The permissions of the file, if it's new. An existing file keeps its
+        permissions.
+
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        pass
+    # Only readable by the user while writing, since it could be the secrets
+    f = tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', delete=False, suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + '.')
+    try:
+        with f:
+            config.write(f)
+        os.chmod(f.name, mode)
+        os.replace(f.name, filename)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
 def save_config(config, filename=None):
     if filename is None:
         filename = default_configfile
-    config.write(open(filename, 'w'))
+    _write(config, filename)
 
 
 def save_secrets(config, filename=None):
     if filename is None:
         filename = default_secretsfile
-    config.write(open(filename, 'w'))
+    _write(config, filename, mode=0o600)
 
 
 def _get_default_secrets():
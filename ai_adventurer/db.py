@@ -150,26 +150,49 @@ class Database(object):
         }
         # How to also return Lines for the given Game?
 
-    def get_games(self, _session=None):
-        """Get a list of games"""
+    def get_games(self, _session=None, with_lines=True):
+        """Get a list of games
+
+        @param with_lines:
+            If the lines of the games should be included. The number of lines
+            is always given, in `lenlines`, so the games could be listed
+            without loading every story.
+
+        """
         if not _session:
             _session = orm.Session(self._engine)
+        lenlines = (
+            sqlalchemy.select(Line.gameid,
+                              sqlalchemy.func.count().label("lenlines"))
+            .group_by(Line.gameid)
+            .subquery()
+        )
+        query = (
+            sqlalchemy.select(Game,
+                              sqlalchemy.func.coalesce(lenlines.c.lenlines, 0))
+            .outerjoin(lenlines, Game.gameid == lenlines.c.gameid)
+            .order_by(Game.gameid)
+        )
+        if with_lines:
+            # All the lines in one query, instead of one per game
+            query = query.options(orm.selectinload(Game.lines))
         ret = []
-        for game in _session.scalars(sqlalchemy.select(Game)):
-            ret.append(
-                {
-                    "gameid": game.gameid,
-                    "title": game.title,
-                    "instructions": game.instructions,
-                    "details": game.details,
-                    "lines": self._convert_lines(game.lines),
-                    "max_token_input": game.max_token_input,
-                    "max_token_output": game.max_token_output,
-                    "summary": game.summary,
-                    "summary_ai": game.summary_ai,
-                    "summary_ai_until_line": game.summary_ai_until_line,
-                }
-            )
+        for game, count in _session.execute(query):
+            data = {
+                "gameid": game.gameid,
+                "title": game.title,
+                "instructions": game.instructions,
+                "details": game.details,
+                "lenlines": count,
+                "max_token_input": game.max_token_input,
+                "max_token_output": game.max_token_output,
+                "summary": game.summary,
+                "summary_ai": game.summary_ai,
+                "summary_ai_until_line": game.summary_ai_until_line,
+            }
+            if with_lines:
+                data["lines"] = self._convert_lines(game.lines)
+            ret.append(data)
         return ret
 
     def get_lines(self, gameid, _session=None):
@@ -179,6 +202,7 @@ class Database(object):
         ret = []
         for line in _session.scalars(
             sqlalchemy.select(Line).where(Line.gameid == gameid)
+            .order_by(Line.lineid)
         ):
             ret.append(line.text)
         return ret
@@ -204,18 +228,19 @@ class Database(object):
         if hasattr(game, "max_token_output"):
             db_game.max_token_output = game.max_token_output
 
-        # This blindly overwrites the existing lines. Probably a better way.
-        line_struct = []
-        for lineno, line in enumerate(game.lines):
-            line_struct.append(
-                Line(
-                    gameid=db_game.gameid,
-                    lineid=lineno,
-                    text=line,
-                )
-            )
-
-        db_game.lines = line_struct
+        # Only the changed lines are written, instead of rewriting the whole
+        # story every time a line is added
+        db_lines = {line.lineid: line for line in db_game.lines}
+        for lineno, text in enumerate(game.lines):
+            line = db_lines.pop(lineno, None)
+            if line is None:
+                db_game.lines.append(
+                    Line(gameid=db_game.gameid, lineid=lineno, text=text))
+            elif line.text != text:
+                line.text = text
+        # The lines that are gone, which are deleted as orphans
+        for line in db_lines.values():
+            db_game.lines.remove(line)
         session.commit()
 
 
@@ -256,6 +256,11 @@ class GUI(object):
         )
         self.loop.widget = body
 
+    def redraw(self):
+        """Repaint the screen, for changes made outside of urwid's callbacks"""
+        if self.loop.screen.started:
+            self.loop.draw_screen()
+
     def send_message(self, text):
         """Add a message to the user"""
         self.footer_text.set_text(text)
@@ -400,9 +405,7 @@ class StoryBox(urwid.Scrollable):
 
     def move_selection_up(self):
         old_id = self.selected_part
-        self.selected_part -= 1
-        if self.selected_part < 0:
-            self.selected_part = 0
+        self.selected_part = max(self.selected_part - 1, 0)
 
         if old_id != self.selected_part:
             newpos = self.load_text()
@@ -410,9 +413,8 @@ class StoryBox(urwid.Scrollable):
 
     def move_selection_down(self):
         old_id = self.selected_part
-        self.selected_part += 1
-        if self.selected_part >= len(self.game.lines):
-            self.selected_part = len(self.game.lines) - 1
+        self.selected_part = min(self.selected_part + 1,
+                                 len(self.game.lines) - 1)
 
         if old_id != self.selected_part:
             newpos = self.load_text()
@@ -420,7 +422,7 @@ class StoryBox(urwid.Scrollable):
 
     def set_selection(self, lineid):
         """Set the selection to a certain part"""
-        if lineid > len(self.game.lines) or lineid <= -1:
+        if lineid >= len(self.game.lines) or lineid <= -1:
             lineid = len(self.game.lines) - 1
 
         old_id = self.selected_part
@@ -512,6 +514,8 @@ class GameLister(Menu):
                 {
                     'title': 'Game title',
                     'lines': ['Intro', 'Sentence 2', ...], # The lines
+                    # or instead of the lines, only the number of them:
+                    'lenlines': 2,
                     'callback': callback, # executes when game is chosen
                 }
 
@@ -528,9 +532,12 @@ class GameLister(Menu):
     def generate_body(self):
         gamelist = []
         for game in self.games:
+            lenlines = game.get('lenlines')
+            if lenlines is None:
+                lenlines = len(game['lines'])
             button = DecorationButton(
                 self.lineformat.format(title=game['title'],
-                                       lenlines=len(game['lines']),
+                                       lenlines=lenlines,
                                        game=game),
                 on_press=game['callback'], user_data=game, left="", right="")
             button.gamedata = game
@@ -3,17 +3,55 @@
 
 """
 
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import httpx
+import json
 import logging
+import os
+import random
 import re
+import threading
 import time
 
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from ai_adventurer import retry
 
 
 logger = logging.getLogger(__name__)
 
 
+# Multiple newlines, to be replaced with at most two (keeping paragraphs)
+_RE_NEWLINES = re.compile(r"\n{3,}")
+
+# Multiple spaces, to be replaced with a single space
+_RE_WS = re.compile(r"[ \t\r\f\v]+")
+
+# What the white space cleaning changes. Most texts have none of these, and
+# checking with `in` is much faster than running the regexes.
+_UNCLEAN_WS = ("\n\n\n", "  ", "\t", "\r", "\f", "\v")
+
+# The indentation of every line, and the whole line if it's a comment
+_RE_COMMENT_LINE = re.compile(r"^[ \t]*(?:%.*(?:\n|$))?", re.MULTILINE)
+
+# Paragraph breaks, when streaming responses
+_RE_PARAGRAPH_BREAK = re.compile(r"\n{2,}")
+
+# A JSON object, possibly wrapped in a markdown code block
+_RE_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _clean_text(text):
+    """Remove unneccessary white space from one string of text"""
+    if not any(ws in text for ws in _UNCLEAN_WS):
+        return text
+    text = _RE_NEWLINES.sub("\n\n", text)
+    return _RE_WS.sub(" ", text)
+
+
 class NotAuthenticatedError(Exception):
     pass
 
@@ -35,6 +73,9 @@ class NLPClient(object):
     # Default max tokens to feed the NLP in prompts
     default_max_tokens_input = 2000  # about 1000 words?
 
+    # If the client is able to reuse the KV-cache from the previous prompt
+    supports_kv_cache = False
+
     def __init__(self, secrets=None, extra=None, modelname=None,
                  max_tokens_output=None, max_tokens_input=None):
         self.secrets = secrets
@@ -49,13 +90,72 @@ class NLPClient(object):
         else:
             self.max_tokens_input = self.default_max_tokens_input
 
+    def _load_model_in_background(self, *args, after_load=None):
+        """Start loading the model in a thread, without blocking the game.
+
+        Loading a local model could take a minute, which is then hidden behind
+        the menus. The `model` attribute waits for the loading to finish.
+
+        @param after_load:
+            Called in the thread after the model is loaded, but before others
+            are let in, e.g. to warm it up.
+
+        """
+        self._model = None
+        self._model_error = None
+        self._model_loaded = threading.Event()
+
+        def load():
+            try:
+                self._model = self._load_model(*args)
+                if after_load:
+                    after_load()
+            except Exception as e:
+                logger.exception("Failed to load model")
+                self._model_error = e
+            finally:
+                self._model_loaded.set()
+
+        self._model_loader = threading.Thread(target=load, daemon=True)
+        self._model_loader.start()
+
+    @property
+    def model(self):
+        """The model, waiting for it if it's still loading"""
+        if threading.current_thread() is not self._model_loader:
+            self._model_loaded.wait()
+        if self._model_error:
+            raise self._model_error
+        return self._model
+
     def prompt(self, text=None, instructions=None, max_tokens_output=None):
         """Subclass for the specifig NLP generation.
 
         Adds the previous dialog to the prompt, for giving context.
         """
-        logger.debug("Prompt instruction given: %s", instructions)
-        logger.debug("Prompt given: %s", text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Prompt instruction given: %s", instructions)
+            logger.debug("Prompt given: %s", text)
+            if isinstance(text, str):
+                logger.debug("Prompt length: %d", len(text))
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None,
+                      **kwargs):
+        """Prompt the NLP and yield the response in chunks, as they come.
+
+        Subclass if the NLP supports streaming. The default is to yield the
+        whole response as one chunk.
+
+        """
+        yield self.prompt(text, instructions=instructions,
+                          max_tokens_output=max_tokens_output, **kwargs)
+
+    def _get_pretext(self, text, instructions=None):
+        """Get the full text to feed models that take plain text"""
+        text = self.convert_to_prompt(text, role="user")
+        if instructions:
+            text = instructions + " " + text
+        return text
 
     def convert_to_prompt(self, text, role='user'):
         """Convert text or list with text to the NLP's formats."""
@@ -79,8 +179,6 @@ class MockNLPClient(NLPClient):
 
     def prompt(self, text=None, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions, max_tokens_output=max_tokens_output)
-        import random
-
         response = random.choice(self.replies)
         logger.debug("Prompt response: %s", response)
         return response
@@ -89,30 +187,60 @@ class MockNLPClient(NLPClient):
 class LocalNLPClient(NLPClient):
     """NLP prompt executed on a model file generated by keras"""
 
+    # The keras dtype policy to run the model with, e.g. "mixed_bfloat16" for
+    # hardware with bfloat16 support (Ampere GPUs, TPUs, newer CPUs), or
+    # "mixed_float16" for older GPUs. Halves the memory used by the weights
+    # and activations. None keeps the policy the model was saved with.
+    dtype_policy = None
+
+    # The lengths that `max_length` is rounded up to. keras compiles the
+    # generate function for every new `max_length`, so with a few fixed
+    # lengths the compiled functions are reused, instead of compiling for
+    # every prompt. The longest is the limit.
+    max_length_buckets = (128, 256, 512, 1024)
+
     def __init__(self, *args, extra=None, **kwargs):
         super().__init__(*args, **kwargs)
         keras_file = extra
-        self.model = self._load_model(keras_file)
+        self._load_model_in_background(keras_file)
 
     def _load_model(self, keras_file):
         import keras
         # import keras_nlp
+        if self.dtype_policy:
+            logger.debug("Using dtype policy: %s", self.dtype_policy)
+            keras.mixed_precision.set_global_policy(self.dtype_policy)
         model = keras.saving.load_model(keras_file, compile=True)
         return model
 
     def prompt(self, text, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions)
-        text = self.convert_to_prompt(text, role="user")
-        if instructions:
-            text = instructions + " " + text
+        text = self._get_pretext(text, instructions)
 
         output = self._generate(text, max_tokens_output=max_tokens_output)
 
         # Remove the pretext, so only the new ouptut is returned
         output = output[len(text):].strip()
+        output = self._trim_output(
+            output, max_tokens_output or self.max_tokens_output)
         logger.debug("Prompt response: %s", output)
         return output
 
+    def _trim_output(self, output, max_tokens):
+        """Cut the output down to about max_tokens
+
+        The max_length is rounded up to a bucket, so the model could generate
+        more than asked for. The tokens are estimated at four characters each,
+        and the output is cut at the last white space, to not split a word.
+
+        """
+        max_chars = max_tokens * 4
+        if len(output) <= max_chars:
+            return output
+        output = output[:max_chars]
+        head, sep, _ = output.rpartition(" ")
+        return (head if sep else output).rstrip()
+
     def _generate(self, pretext, max_tokens_output=None):
         logger.debug("Generating with prompt: '%s'", pretext)
         logger.debug("Prompt length: %s", len(pretext))
@@ -120,8 +248,8 @@ class LocalNLPClient(NLPClient):
         start = time.time()
         output = self.model.generate(
             pretext,
-            max_length=min(1024, len(pretext) + (max_tokens_output or
-                                                 self.max_tokens_output))
+            max_length=self._get_max_length(
+                len(pretext) + (max_tokens_output or self.max_tokens_output))
         ).strip()
         end = time.time()
 
@@ -129,28 +257,115 @@ class LocalNLPClient(NLPClient):
         logger.debug("Time elapsed: %.2f seconds", end - start)
         return output
 
+    def _get_max_length(self, length):
+        """Round the length up to the nearest of the max_length_buckets"""
+        buckets = self.max_length_buckets
+        i = bisect.bisect_left(buckets, length)
+        return buckets[min(i, len(buckets) - 1)]
+
 
 class HuggingfaceNLPClient(NLPClient):
     """Download a model from HuggingFace and prompt locally"""
 
+    # The mode given to `torch.compile` for the models forward pass, e.g.
+    # "reduce-overhead" or "max-autotune". Compiling fuses the operations into
+    # optimized kernels, cutting the per token overhead. It's combined with a
+    # static KV-cache, so the decoding steps keep the same shapes, but every
+    # new prompt length still triggers a recompile of the prefill. None runs
+    # the model in eager mode.
+    torch_compile_mode = None
+
+    # Weight-only quantization of the model, "int8" or "nf4", while computing
+    # in bfloat16. Halves (or quarters) the memory the weights need, which is
+    # usually what limits the speed of generating text. Needs bitsandbytes and
+    # a CUDA GPU. Could also be set after the model id, e.g.
+    # "huggingface:meta-llama/Llama-3.2-1B:int8".
+    quantization = None
+
+    # The attention implementation, e.g. "sdpa" for PyTorch's fused
+    # scaled_dot_product_attention, or "flash_attention_2". None lets
+    # transformers choose, which is "sdpa" when the model supports it.
+    attn_implementation = None
+
+    supports_kv_cache = True
+
     def __init__(self, *args, extra=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.modelid = extra
-        self.model = self._load_model(self.modelid)
+        if extra and ":" in extra:
+            self.modelid, self.quantization = extra.split(":", 1)
+        # The KV-cache from the previous prompt, and the token ids it covers
+        self._past_key_values = None
+        self._cached_ids = []
+        after_load = None
+        if self.torch_compile_mode:
+            # The static cache can't be cropped and reused between prompts
+            self.supports_kv_cache = False
+            after_load = self._warmup
+        self._load_model_in_background(self.modelid, after_load=after_load)
 
     def _load_model(self, modelid):
         from transformers import pipeline
         import torch
         logger.debug(f"Try to load HF model {modelid!r}")
-        return pipeline("text-generation", model=modelid,
-                        model_kwargs={"torch_dtype": torch.bfloat16},
-                        device_map="auto")
+        model_kwargs = {"torch_dtype": torch.bfloat16}
+        if self.attn_implementation:
+            # Must be given when loading, changing the config later is ignored
+            model_kwargs["attn_implementation"] = self.attn_implementation
+        quantization_config = self._get_quantization_config()
+        if quantization_config:
+            model_kwargs["quantization_config"] = quantization_config
+        pipe = pipeline("text-generation", model=modelid,
+                        model_kwargs=model_kwargs, device_map="auto")
+        if self.torch_compile_mode:
+            logger.debug("Compiling model, mode: %s", self.torch_compile_mode)
+            # The pipeline calls `model.generate`, which calls `forward`, so
+            # it's the forward pass that must be compiled, not the model
+            # object.
+            pipe.model.generation_config.cache_implementation = "static"
+            pipe.model.forward = torch.compile(pipe.model.forward,
+                                               mode=self.torch_compile_mode,
+                                               fullgraph=False)
+        return pipe
+
+    def _get_quantization_config(self):
+        """Get the config for quantizing the model, if set and supported"""
+        if not self.quantization:
+            return None
+        import torch
+        if not torch.cuda.is_available():
+            logger.warning("Quantization needs CUDA, loading %s in bfloat16",
+                           self.modelid)
+            return None
+        from transformers import BitsAndBytesConfig
+        if self.quantization == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        if self.quantization == "nf4":
+            # Double quantization also quantizes the quantization constants,
+            # saving another ~0.4 bits per weight
+            return BitsAndBytesConfig(load_in_4bit=True,
+                                      bnb_4bit_quant_type="nf4",
+                                      bnb_4bit_use_double_quant=True,
+                                      bnb_4bit_compute_dtype=torch.bfloat16)
+        raise ValueError(f"Unknown quantization: {self.quantization!r}")
+
+    def _warmup(self):
+        """Run a tiny generation, so the first real prompt is not waiting.
+
+        The compilation of the model happens at the first run, which is slow.
 
-    def prompt(self, text, instructions=None, max_tokens_output=None):
+        """
+        start = time.time()
+        self._generate("Once upon a time", max_tokens_output=1)
+        logger.debug("Warmup time: %.2f seconds", time.time() - start)
+
+    def prompt(self, text, instructions=None, max_tokens_output=None,
+               use_kv_cache=False):
         super().prompt(text, instructions)
-        text = self.convert_to_prompt(text, role="user")
-        if instructions:
-            text = instructions + " " + text
+        text = self._get_pretext(text, instructions)
+        if use_kv_cache:
+            return self._generate_with_cache(
+                text, max_tokens_output=max_tokens_output)
         output = self._generate(text, max_tokens_output=max_tokens_output)
         return output
 
@@ -170,6 +385,158 @@ class HuggingfaceNLPClient(NLPClient):
         logger.debug("Time elapsed: %.2f seconds", end - start)
         return output
 
+    def _generate_with_cache(self, pretext, max_tokens_output=None):
+        """Generate, reusing the KV-cache from the previous prompt.
+
+        The story only grows by a few lines per turn, so most of the prompt is
+        the same as in the previous turn. Only the tokens after the prefix that
+        is shared with the previous prompt are then encoded.
+
+        """
+        logger.debug("Generating with prompt: '%s'", pretext)
+        logger.debug("Prompt length: %s", len(pretext))
+        start = time.time()
+        tokenizer = self.model.tokenizer
+        model = self.model.model
+        encoded = tokenizer(pretext, return_tensors="pt").to(model.device)
+        input_ids = encoded.input_ids
+        ids = input_ids[0].tolist()
+
+        cache = self._past_key_values
+        if cache is not None:
+            common = 0
+            for old_id, new_id in zip(self._cached_ids, ids):
+                if old_id != new_id:
+                    break
+                common += 1
+            # The model needs at least one new token to process
+            common = min(common, len(ids) - 1)
+            if common and hasattr(cache, "crop"):
+                cache.crop(common)
+            else:
+                cache = None
+            logger.debug("Reusing KV-cache for %d of %d tokens", common,
+                         len(ids))
+
+        generated = model.generate(
+            input_ids,
+            attention_mask=encoded.attention_mask,
+            past_key_values=cache,
+            use_cache=True,
+            max_new_tokens=max_tokens_output or self.max_tokens_output,
+            pad_token_id=tokenizer.eos_token_id,
+            return_dict_in_generate=True,
+        )
+        sequence = generated.sequences[0]
+        self._past_key_values = generated.past_key_values
+        self._cached_ids = sequence.tolist()
+        output = tokenizer.decode(sequence[len(ids):],
+                                  skip_special_tokens=True)
+        end = time.time()
+
+        logger.debug("Returned answer: %s", output)
+        logger.debug("Time elapsed: %.2f seconds", end - start)
+        return output
+
+
+class LlamaCppNLPClient(NLPClient):
+    """Prompt a GGUF model file locally, through llama.cpp
+
+    Quantized files, like Q4_K_M, run fast on the CPU. The K_M variants keep
+    the embedding and output layers at a higher precision.
+
+    https://github.com/abetlen/llama-cpp-python
+
+    """
+
+    # The context size, in tokens
+    n_ctx = 4096
+
+    # How many layers to offload to the GPU, -1 for all of them
+    n_gpu_layers = 0
+
+    def __init__(self, *args, extra=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model_path = extra
+        self._load_model_in_background(self.model_path)
+
+    def _load_model(self, model_path):
+        from llama_cpp import Llama
+        logger.debug(f"Try to load GGUF model {model_path!r}")
+        return Llama(model_path=model_path, n_ctx=self.n_ctx,
+                     n_threads=os.cpu_count(), n_gpu_layers=self.n_gpu_layers,
+                     verbose=False)
+
+    def prompt(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions)
+        text = self._get_pretext(text, instructions)
+        logger.debug("Prompt length: %s", len(text))
+        start = time.time()
+        # llama.cpp reuses the evaluated tokens that the prompt shares with
+        # the previous one, so continuing the story is cheap.
+        raw = self.model(
+            text, max_tokens=max_tokens_output or self.max_tokens_output)
+        output = raw["choices"][0]["text"].strip()
+        logger.debug("Returned answer: %s", output)
+        logger.debug("Time elapsed: %.2f seconds", time.time() - start)
+        return output
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions)
+        text = self._get_pretext(text, instructions)
+        for chunk in self.model(
+                text, stream=True,
+                max_tokens=max_tokens_output or self.max_tokens_output):
+            yield chunk["choices"][0]["text"]
+
+
+class VLLMNLPClient(NLPClient):
+    """Prompt a HuggingFace model locally, through vLLM
+
+    vLLM's paged attention and fused CUDA kernels are faster than the
+    transformers pipeline. It needs a GPU.
+
+    https://docs.vllm.ai/
+
+    """
+
+    # The sampling temperature
+    temperature = 0.75
+
+    # How much of the GPU memory vLLM could take, for the weights and the
+    # KV-cache
+    gpu_memory_utilization = 0.85
+
+    def __init__(self, *args, extra=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modelid = extra
+        self._load_model_in_background(self.modelid)
+
+    def _load_model(self, modelid):
+        from vllm import LLM
+        logger.debug(f"Try to load vLLM model {modelid!r}")
+        # Prefix caching keeps the KV-cache of previous prompts. Each prompt
+        # for the next lines starts with the previous one, so only the new
+        # lines need to be processed.
+        return LLM(model=modelid, dtype="bfloat16",
+                   enable_prefix_caching=True,
+                   gpu_memory_utilization=self.gpu_memory_utilization)
+
+    def prompt(self, text, instructions=None, max_tokens_output=None):
+        from vllm import SamplingParams
+        super().prompt(text, instructions)
+        text = self._get_pretext(text, instructions)
+        logger.debug("Prompt length: %s", len(text))
+        params = SamplingParams(
+            temperature=self.temperature,
+            max_tokens=max_tokens_output or self.max_tokens_output)
+        start = time.time()
+        outputs = self.model.generate([text], params, use_tqdm=False)
+        output = outputs[0].outputs[0].text.strip()
+        logger.debug("Returned answer: %s", output)
+        logger.debug("Time elapsed: %.2f seconds", time.time() - start)
+        return output
+
 
 class OnlineNLPClient(NLPClient):
     """NLP models that uses an online API for prompts."""
@@ -180,6 +547,20 @@ class OnlineNLPClient(NLPClient):
     # Name of the key in the DEFAULT section of secrets.ini for the api-key
     secrets_api_key_name = None
 
+    # How many times to retry when rate limited or the API is overloaded
+    max_retries = 5
+
+    # Max seconds to wait before a retry, even if the API asks for longer
+    max_retry_wait = 60
+
+    # Exceptions to retry, besides the HTTP errors in retry.retry_statuses
+    retry_on = (httpx.NetworkError,)
+
+    # Exceptions to never retry. Timeouts are not retried, since the user has
+    # waited long enough already. httpx.TimeoutException is not a
+    # NetworkError, but the SDKs have their own timeout exceptions.
+    no_retry_on = (httpx.TimeoutException,)
+
     def _get_api_key(self):
         api_key = None
         try:
@@ -194,6 +575,13 @@ class OnlineNLPClient(NLPClient):
                 "Invalid API key - see " + self.api_key_url)
         return api_key
 
+    def _with_retry(self, func):
+        """Wrap an API call, to retry it when rate limited"""
+        return retry.with_retry(func, max_retries=self.max_retries,
+                                max_wait=self.max_retry_wait,
+                                retry_on=self.retry_on,
+                                no_retry_on=self.no_retry_on)
+
     def convert_to_prompt(self, text, role='user'):
         """Convert text or list with text to the NLP's formats.
 
@@ -210,17 +598,10 @@ class OnlineNLPClient(NLPClient):
 
         """
         assert role in ('user', 'system')
-        if isinstance(text, str):
-            text = (text,)
-        if isinstance(text, dict):
+        if isinstance(text, (str, dict)):
             text = (text,)
-        ret = []
-        for t in text:
-            if isinstance(t, dict):
-                ret.append(t)
-            else:
-                ret.append({"role": role, "content": t})
-        return ret
+        return [t if type(t) is dict else {"role": role, "content": t}
+                for t in text]
 
 
 class MockOnlineNLPClient(OnlineNLPClient):
@@ -246,13 +627,42 @@ class MockOnlineNLPClient(OnlineNLPClient):
 
     def prompt(self, text=None, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions, max_tokens_output=max_tokens_output)
-        import random
-
         response = random.choice(self.replies)
         logger.debug("Prompt response: %s", response)
         return response
 
 
+# The connection pool for the online APIs. httpx closes idle connections
+# after 5 seconds by default, which is shorter than the time the user spends
+# reading and writing between prompts. Keeping them open a while longer saves
+# the TCP and TLS handshakes on the next prompt.
+_http_limits = httpx.Limits(max_connections=20, max_keepalive_connections=4,
+                            keepalive_expiry=120)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_openai_client(api_key):
+    """Get an OpenAI client, shared by all clients with the same API key.
+
+    Each SDK client has its own connection pool, so sharing them reuses the
+    open connections.
+
+    """
+    from openai import OpenAI, DefaultHttpxClient
+    # Retries are handled by _with_retry, like for the other APIs
+    return OpenAI(api_key=api_key, max_retries=0,
+                  http_client=DefaultHttpxClient(limits=_http_limits))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_mistral_client(api_key):
+    """Get a Mistral client, shared by all clients with the same API key"""
+    from mistralai import Mistral
+    return Mistral(api_key=api_key,
+                   client=httpx.Client(limits=_http_limits,
+                                       follow_redirects=True))
+
+
 class OpenAINLPClient(OnlineNLPClient):
     """NLP models from OpenAI
 
@@ -267,25 +677,22 @@ class OpenAINLPClient(OnlineNLPClient):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        from openai import OpenAI
-        self.client = OpenAI(api_key=self._get_api_key())
+        self.client = _get_openai_client(self._get_api_key())
+        # The SDK wraps the connection errors in its own exception, of which
+        # its timeout is a subclass
+        from openai import APIConnectionError, APITimeoutError
+        self.retry_on = (APIConnectionError,)
+        self.no_retry_on = (APITimeoutError,)
         if not self.modelname:
             self.modelname = self.openai_model
         logger.debug(f"Model: {self.modelname}")
 
     def prompt(self, text, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions, max_tokens_output=max_tokens_output)
-        # Reformat the prompt to follow OpenAIs specs:
-        new_text = []
-        if instructions:
-            new_text.extend(self.convert_to_prompt(instructions,
-                                                   role='system'))
-        new_text.extend(self.convert_to_prompt(text))
-
         starttime = time.time()
-        answer = self.client.chat.completions.create(
+        answer = self._with_retry(self.client.chat.completions.create)(
             model=self.modelname,
-            messages=new_text,
+            messages=self._get_messages(text, instructions),
             max_tokens=max_tokens_output or self.max_tokens_output,
             n=1,
             stream=False,
@@ -295,6 +702,30 @@ class OpenAINLPClient(OnlineNLPClient):
         answer = answer.choices[0].message.content
         return answer
 
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions, max_tokens_output=max_tokens_output)
+        starttime = time.time()
+        stream = self._with_retry(self.client.chat.completions.create)(
+            model=self.modelname,
+            messages=self._get_messages(text, instructions),
+            max_tokens=max_tokens_output or self.max_tokens_output,
+            n=1,
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        logger.debug("Response time: %.3f", time.time() - starttime)
+
+    def _get_messages(self, text, instructions=None):
+        """Reformat the prompt to follow OpenAIs specs"""
+        messages = []
+        if instructions:
+            messages.extend(self.convert_to_prompt(instructions,
+                                                   role='system'))
+        messages.extend(self.convert_to_prompt(text))
+        return messages
+
 
 class GeminiNLPClient(OnlineNLPClient):
     """NLP models from Google.
@@ -334,18 +765,29 @@ class GeminiNLPClient(OnlineNLPClient):
     # of the `Model` returned the `genai.get_model` function.
     top_p = 1.0
 
-    # Google's tresholds are very sensitive, so need to adjust these. Keep low
-    # for now.
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT:
-            HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HARASSMENT:
-            HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH:
-            HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT:
-            HarmBlockThreshold.BLOCK_NONE,
-    }
+    @functools.cached_property
+    def safety_settings(self):
+        """Google's tresholds are very sensitive, so need to adjust these.
+
+        Keep low for now. A property, so the SDK is only imported when Gemini
+        is used.
+
+        """
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+        return {
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT:
+                HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HARASSMENT:
+                HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH:
+                HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT:
+                HarmBlockThreshold.BLOCK_NONE,
+        }
+
+    # How many configured models to keep for reuse. The instructions differ
+    # per game, so a few are needed when switching between games.
+    model_cache_size = 8
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -353,25 +795,19 @@ class GeminiNLPClient(OnlineNLPClient):
             self.modelname = self.google_model
         import google.generativeai as genai
         genai.configure(api_key=self._get_api_key())
+        # Has the code 504, which is otherwise retried
+        from google.api_core.exceptions import DeadlineExceeded
+        self.no_retry_on = (DeadlineExceeded,)
+        self._genai = genai
+        self._model_cache = collections.OrderedDict()
         logger.debug(f"Model: {self.modelname}")
 
     def prompt(self, text, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions)
-        import google.generativeai as genai
-        generation_config = genai.GenerationConfig(
-            candidate_count=1,
-            max_output_tokens=max_tokens_output or self.max_tokens_output,
-            temperature=self.temperature,
-            top_p=self.top_p,
-        )
-        client = genai.GenerativeModel(
-            self.modelname,
-            safety_settings=self.safety_settings,
-            system_instruction=instructions,
-            generation_config=generation_config,
-        )
+        client = self._get_model(instructions,
+                                 max_tokens_output or self.max_tokens_output)
         starttime = time.time()
-        response = client.generate_content(
+        response = self._with_retry(client.generate_content)(
             contents=text,
         )
         logger.debug("Response time: %.3f", time.time() - starttime)
@@ -388,6 +824,50 @@ class GeminiNLPClient(OnlineNLPClient):
         logger.debug("Prompt response: %s", answer)
         return answer
 
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions)
+        client = self._get_model(instructions,
+                                 max_tokens_output or self.max_tokens_output)
+        response = self._with_retry(client.generate_content)(
+            contents=text,
+            stream=True,
+        )
+        for chunk in response:
+            try:
+                yield chunk.text
+            except ValueError:
+                logger.debug("Blocked by Gemini: '%r'", chunk)
+                # TODO: rather raise an exception?
+                yield str(response.prompt_feedback)
+                return
+
+    def _get_model(self, instructions, max_tokens_output):
+        """Get a configured model, reusing it if the settings are unchanged"""
+        key = (self.modelname, instructions, max_tokens_output,
+               self.temperature, self.top_p)
+        client = self._model_cache.get(key)
+        if client is not None:
+            self._model_cache.move_to_end(key)
+            return client
+
+        genai = self._genai
+        generation_config = genai.GenerationConfig(
+            candidate_count=1,
+            max_output_tokens=max_tokens_output,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+        client = genai.GenerativeModel(
+            self.modelname,
+            safety_settings=self.safety_settings,
+            system_instruction=instructions,
+            generation_config=generation_config,
+        )
+        self._model_cache[key] = client
+        if len(self._model_cache) > self.model_cache_size:
+            self._model_cache.popitem(last=False)
+        return client
+
     def convert_to_prompt(self, text, role='user'):
         """Convert to Geminis prompt format.
 
@@ -403,17 +883,10 @@ class GeminiNLPClient(OnlineNLPClient):
         """
         if role == 'system':
             role = 'model'
-        if isinstance(text, str):
+        if isinstance(text, (str, dict)):
             text = (text,)
-        if isinstance(text, dict):
-            text = (text,)
-        ret = []
-        for t in text:
-            if isinstance(t, dict):
-                ret.append(t)
-            else:
-                ret.append({"role": role, "parts": t})
-        return ret
+        return [t if type(t) is dict else {"role": role, "parts": t}
+                for t in text]
 
 
 class MistralNLP(OnlineNLPClient):
@@ -447,44 +920,55 @@ class MistralNLP(OnlineNLPClient):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        from mistralai import Mistral
-        self.client = Mistral(api_key=self._get_api_key())
+        from mistralai.models.sdkerror import SDKError
+        self.client = _get_mistral_client(self._get_api_key())
+        self._sdk_error = SDKError
         if not self.modelname:
             self.modelname = self.mistral_model
 
     def prompt(self, text, instructions=None, max_tokens_output=None):
         super().prompt(text, instructions, max_tokens_output=max_tokens_output)
-        # Reformat the prompt to follow Mistrals specs:
-        new_text = []
+        response = self._retry(self._prompt,
+                               self._get_messages(text, instructions),
+                               max_tokens_output=max_tokens_output)
+        logger.debug("Token usage: %r", response.usage)
+        answer = response.choices[0].message.content
+        logger.debug("Prompt response: %s", answer)
+        return answer
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions, max_tokens_output=max_tokens_output)
+        stream = self._retry(self._prompt_stream,
+                             self._get_messages(text, instructions),
+                             max_tokens_output=max_tokens_output)
+        with stream as events:
+            for event in events:
+                content = event.data.choices[0].delta.content
+                if content:
+                    yield content
+
+    def _get_messages(self, text, instructions=None):
+        """Reformat the prompt to follow Mistrals specs"""
+        messages = []
         if instructions:
-            new_text.extend(self.convert_to_prompt(instructions,
+            messages.extend(self.convert_to_prompt(instructions,
                                                    role="system"))
-        new_text.extend(self.convert_to_prompt(text))
+        messages.extend(self.convert_to_prompt(text))
+        return messages
 
-        import mistralai
+    def _retry(self, func, *args, **kwargs):
+        """Call the API, and retry if the requests rate limit is exceeded"""
         try:
-            response = self._prompt(new_text,
-                                    max_tokens_output=max_tokens_output)
-        except mistralai.models.sdkerror.SDKError as e:
+            return self._with_retry(func)(*args, **kwargs)
+        except self._sdk_error as e:
             if e.status_code == 401:
                 raise NotAuthenticatedError(e)
-            if e.status_code == 429:
-                # {"message":"Requests rate limit exceeded"}
-                time.sleep(2)
-                logger.debug("Requests rate limit exceeded, retrying...")
-                # Retry once. Maybe more?
-                response = self._prompt(new_text)
+            # {"message":"Requests rate limit exceeded"}
             logger.critical(e, exc_info=True)
             raise e
-        # TODO: check for limit exceptions
         except httpx.ReadTimeout as e:
             raise TimeoutException(e)
 
-        logger.debug("Token usage: %r", response.usage)
-        answer = response.choices[0].message.content
-        logger.debug("Prompt response: %s", answer)
-        return answer
-
     def _prompt(self, text, max_tokens_output=None):
         starttime = time.time()
         response = self.client.chat.complete(
@@ -500,6 +984,17 @@ class MistralNLP(OnlineNLPClient):
         logger.debug("Response time: %.3f seconds", time.time() - starttime)
         return response
 
+    def _prompt_stream(self, text, max_tokens_output=None):
+        return self.client.chat.stream(
+            model=self.modelname,
+            messages=text,
+            max_tokens=max_tokens_output or self.max_tokens_output,
+            timeout_ms=self.timeout_ms,
+            safe_prompt=False,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+
     def convert_to_prompt(self, text, role='user', prefix=False):
         """Convert text or list with text to the NLP's formats.
 
@@ -512,6 +1007,80 @@ class MistralNLP(OnlineNLPClient):
         return text
 
 
+class FallbackNLPClient(NLPClient):
+    """Prompt the first of the given clients that works.
+
+    Used when the model is set to a comma separated list of models, e.g.
+    "gemini-1.5-flash,gpt-4o-mini", so the game goes on with the next model
+    when one is rate limited or down.
+
+    """
+
+    # How long to try the other clients first after a client failed, in
+    # seconds
+    failure_timeout = 30
+
+    def __init__(self, clients, **kwargs):
+        super().__init__(**kwargs)
+        self.clients = clients
+        # When each client last failed, in monotonic time
+        self._failed_at = {}
+        self.max_tokens_input = min(c.max_tokens_input for c in clients)
+
+    def _get_clients(self):
+        """The clients in the order to try them.
+
+        The clients that failed lately are tried last, instead of being left
+        out, in case all are failing.
+
+        """
+        now = time.monotonic()
+
+        def failed_lately(client):
+            failed_at = self._failed_at.get(client)
+            return (failed_at is not None
+                    and now - failed_at < self.failure_timeout)
+
+        return sorted(self.clients, key=failed_lately)
+
+    def _failed(self, client, error):
+        logger.warning("NLP %s failed, trying the next: %r", client.modelname,
+                       error)
+        self._failed_at[client] = time.monotonic()
+
+    def prompt(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions)
+        error = None
+        for client in self._get_clients():
+            try:
+                return client.prompt(text, instructions=instructions,
+                                     max_tokens_output=max_tokens_output)
+            except Exception as e:
+                self._failed(client, e)
+                error = e
+        raise error
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        super().prompt(text, instructions)
+        error = None
+        for client in self._get_clients():
+            started = False
+            try:
+                for chunk in client.prompt_stream(
+                        text, instructions=instructions,
+                        max_tokens_output=max_tokens_output):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                # Can't take back what is already given
+                if started:
+                    raise
+                self._failed(client, e)
+                error = e
+        raise error
+
+
 nlp_models = {
     "gemini-1.5-flash": GeminiNLPClient,
     "gemini-1.5-pro": GeminiNLPClient,
@@ -523,9 +1092,12 @@ nlp_models = {
     "mistral-small-latest": MistralNLP,
     "mock": MockNLPClient,
     "mock-online": MockOnlineNLPClient,
-    # TODO: would probably also need a file name
-    # "local": LocalNLPClient,
+    # Needs the path to the keras file, e.g. "local:model.keras"
+    "local": LocalNLPClient,
     "huggingface": HuggingfaceNLPClient,
+    "llama-cpp": LlamaCppNLPClient,
+    # Needs the HuggingFace model id, e.g. "vllm:meta-llama/Llama-3.2-1B"
+    "vllm": VLLMNLPClient,
 }
 
 
@@ -541,6 +1113,26 @@ class NLPHandler(object):
 
     """
 
+    # The prompt for continuing the story, sent as one message
+    next_lines_template = (
+        "Generate two more sentences, continuing the given story:\n"
+        "\n---\nThe title of the story: '{title}'"
+        "{details}\n"
+        "\n---\n<THE-STORY>:\n\n"
+        "{story}\n"
+        "\n</THE-STORY>"
+    )
+    next_lines_details_template = (
+        "\n\n---\nImportant details about the story:\n{details}"
+    )
+    next_lines_summary_template = (
+        "\n\n---\nSummary of the story so far:\n{summary}"
+    )
+
+    # How many of the last parts of the story to keep as is when summarizing
+    # the rest, so the AI continues from the actual text
+    summary_keep_lines = 4
+
     default_instructions = """
         % This is the instructions that is given to the AI before the story.
         % - All lines starting with percent (%) are removed for the AI.
@@ -567,12 +1159,44 @@ class NLPHandler(object):
 
         """
 
-    def __init__(self, modelname, secrets):
+    # How many responses to keep in memory, for reuse by identical prompts
+    memory_cache_size = 256
+
+    # How long responses are kept in memory, in seconds
+    memory_cache_expire = 3600
+
+    # How long responses are kept in the disk cache, in seconds
+    disk_cache_expire = 86400 * 30
+
+    # Generate the next lines in the background after each turn, so they are
+    # ready when the player asks for more. Costs an extra prompt whenever the
+    # player changes the story instead. Only for the online models, since the
+    # local models can't run two prompts at the same time.
+    prefetch = False
+
+    def __init__(self, modelname, secrets, cache_dir=None, prefetch=None):
         self.nlp_client = self.load_model(modelname, secrets)
+        if prefetch is not None:
+            self.prefetch = prefetch
+        clients = getattr(self.nlp_client, "clients", (self.nlp_client,))
+        if self.prefetch and not all(isinstance(c, OnlineNLPClient)
+                                     for c in clients):
+            logger.warning("Prefetching is only supported by online models")
+            self.prefetch = False
+        # The prompt and the future response of the prefetched next lines
+        self._prefetched = None
+        self.memory_cache = collections.OrderedDict()
+        self.disk_cache = None
+        if cache_dir:
+            # Optional dependency, only needed when the cache is enabled
+            import diskcache
+            self.disk_cache = diskcache.Cache(cache_dir)
 
     @staticmethod
     def load_model(modelname, secrets):
         """Instantiate correct NLP model by given input"""
+        if ',' in modelname:
+            return NLPHandler._load_fallback_models(modelname, secrets)
         extra = None
         if ':' in modelname:
             modelname, extra = modelname.split(':', 1)
@@ -582,17 +1206,35 @@ class NLPHandler(object):
         nlp_class = nlp_models[modelname]
         return nlp_class(secrets=secrets, extra=extra, modelname=modelname)
 
+    @staticmethod
+    def _load_fallback_models(modelnames, secrets):
+        """Load the comma separated models, skipping those without API key"""
+        clients = []
+        error = None
+        for modelname in modelnames.split(','):
+            try:
+                clients.append(NLPHandler.load_model(modelname.strip(),
+                                                     secrets))
+            except NotAuthenticatedError as e:
+                logger.warning("Skipping NLP %s: %s", modelname, e)
+                error = error or e
+        if not clients:
+            raise error
+        # Fall back right away, instead of first waiting out a rate limit. The
+        # last model keeps its retries, for when all of them are failing.
+        for client in clients[:-1]:
+            client.max_retries = 0
+        return FallbackNLPClient(clients, secrets=secrets,
+                                 modelname=modelnames)
+
     def clean_text(self, text):
         """Remove unneccessary white space and other generic mess"""
         if isinstance(text, (list, tuple)):
             return [self.clean_text(t) for t in text]
-        # Replace multiple newlines with at most two (keeping paragraphs)
-        text = re.sub(r"\n{3,}", "\n\n", text)
-        # Replace multiple spaces with a single space
-        text = re.sub(r"[ \t\r\f\v]+", " ", text)
-        return text
+        return _clean_text(text)
 
     @staticmethod
+    @functools.lru_cache(maxsize=32)
     def remove_internal_comments(text):
         """Remove internal comments from given text - lines starting with "%".
 
@@ -604,38 +1246,172 @@ class NLPHandler(object):
             % This is an internal comment, used for helping the end user
             This is the text that the AI language model should care about.
 
+        The result is cached, since the same instructions and story details
+        are cleaned for every prompt.
+
         """
-        ret = []
-        for line in text.splitlines():
-            line = line.lstrip()
-            if not line.startswith("%"):
-                ret.append(line)
-        return "\n".join(ret)
+        text = _RE_COMMENT_LINE.sub("", text)
+        # Like joining the lines, without a newline at the end
+        if text.endswith("\n"):
+            text = text[:-1]
+        return text
 
     def prompt(self, text, instructions=None, return_raw=False,
-               max_tokens_output=None):
-        """Ask the NLP and return the result"""
+               max_tokens_output=None, use_kv_cache=False, use_cache=True,
+               callback=None):
+        """Ask the NLP and return the result
+
+        @param use_kv_cache:
+            Reuse the KV-cache from the previous prompt, if the NLP client
+            supports it. Only useful when the prompt starts the same as the
+            previous one, e.g. when continuing the story.
+
+        @param use_cache:
+            Reuse the response from an identical prompt, from memory or from
+            the disk cache if enabled. Set to False when a new response is
+            wanted.
+
+        @param callback:
+            Called with each chunk of the response as it's streamed from the
+            NLP, e.g. for showing it before the whole response is ready.
+
+        """
         # TODO: handle the text in various formats
         if instructions is None:
             instructions = self.default_instructions
-
-        response = self.nlp_client.prompt(
-            # TODO: use self.remove_internal_comments on text input too?
-            text=self.clean_text(text),
-            instructions=self.remove_internal_comments(instructions),
-            max_tokens_output=max_tokens_output,
-        )
+        # TODO: use self.remove_internal_comments on text input too?
+        text = self.clean_text(text)
+        instructions = self.remove_internal_comments(instructions)
+
+        key = None
+        if use_cache:
+            key = self._get_cache_key(text, instructions, max_tokens_output)
+            response = self._get_cached(key)
+            if response is not None:
+                if callback:
+                    callback(response)
+                if return_raw:
+                    return response
+                return self.clean_text(response)
+
+        kwargs = {}
+        if use_kv_cache and self.nlp_client.supports_kv_cache:
+            kwargs["use_kv_cache"] = True
+
+        if callback:
+            chunks = []
+            for chunk in self.nlp_client.prompt_stream(
+                    text, instructions=instructions,
+                    max_tokens_output=max_tokens_output, **kwargs):
+                callback(chunk)
+                chunks.append(chunk)
+            response = "".join(chunks)
+        else:
+            response = self.nlp_client.prompt(
+                text=text,
+                instructions=instructions,
+                max_tokens_output=max_tokens_output,
+                **kwargs
+            )
+        if key is not None:
+            self._set_cached(key, response)
         if return_raw:
             return response
         return self.clean_text(response)
 
+    def _get_cache_key(self, text, instructions, max_tokens_output):
+        """Hash everything that affects the response from the NLP"""
+        data = repr((type(self.nlp_client).__name__,
+                     self.nlp_client.modelname, text, instructions,
+                     max_tokens_output))
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def _get_cached(self, key):
+        """Get a cached response, first from memory, then from disk"""
+        expires, response = self.memory_cache.get(key, (None, None))
+        if response is not None:
+            if expires > time.monotonic():
+                logger.debug("Response found in memory cache")
+                self.memory_cache.move_to_end(key)
+                return response
+            del self.memory_cache[key]
+            response = None
+        if self.disk_cache is not None:
+            response = self.disk_cache.get(key)
+            if response is not None:
+                logger.debug("Response found in disk cache")
+                self._set_cached(key, response, to_disk=False)
+        return response
+
+    def _set_cached(self, key, response, to_disk=True):
+        expires = time.monotonic() + self.memory_cache_expire
+        self.memory_cache[key] = (expires, response)
+        self.memory_cache.move_to_end(key)
+        if len(self.memory_cache) > self.memory_cache_size:
+            self.memory_cache.popitem(last=False)
+        if to_disk and self.disk_cache is not None:
+            self.disk_cache.set(key, response, expire=self.disk_cache_expire)
+
+    def clear_cache(self):
+        """Forget all cached responses, in memory and on disk"""
+        self.memory_cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
+
+    async def aprompt_stream(self, text, instructions=None,
+                             max_tokens_output=None, use_kv_cache=False):
+        """Ask the NLP, and yield the response paragraph by paragraph.
+
+        The response is streamed from the NLP client in a background thread,
+        so each paragraph is cleaned while the next chunks are on their way.
+
+        """
+        if instructions is None:
+            instructions = self.default_instructions
+        text = self.clean_text(text)
+        instructions = self.remove_internal_comments(instructions)
+
+        kwargs = {}
+        if use_kv_cache and self.nlp_client.supports_kv_cache:
+            kwargs["use_kv_cache"] = True
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        finished = object()
+
+        def receive_chunks():
+            try:
+                for chunk in self.nlp_client.prompt_stream(
+                        text, instructions=instructions,
+                        max_tokens_output=max_tokens_output, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+        receiver = loop.run_in_executor(None, receive_chunks)
+        buffer = ""
+        while True:
+            chunk = await queue.get()
+            if chunk is finished:
+                break
+            buffer += chunk or ""
+            # Only clean the paragraphs that are completed
+            *paragraphs, buffer = _RE_PARAGRAPH_BREAK.split(buffer)
+            for paragraph in paragraphs:
+                if paragraph.strip():
+                    yield self.clean_text(paragraph.strip("\n"))
+        # Raise any exception from the NLP client
+        await receiver
+        if buffer.strip():
+            yield self.clean_text(buffer.strip("\n"))
+
     def prompt_for_concept(self):
         """Ask the AI for a random concept for a story and return it."""
         concept = self.prompt(
             """Give me 100-200 words describing an idea for one exiting fantasy
             story. Only return one story. Return a summary of the story,
             including a chapter layout and character descriptions. Do not start
-            the story.""", max_tokens_output=800)
+            the story.""", max_tokens_output=800, use_cache=False)
         # TODO; might change this depending on what AI model to use?
 
         # TODO: Make use of the APIs possibility to fill a object with the
@@ -651,48 +1427,173 @@ class NLPHandler(object):
             formatting: {concept_or_summary}
             """, max_tokens_output=20)
         # TODO; might change this depending on what AI model to use
+        return self._clean_title(title)
 
+    @staticmethod
+    def _clean_title(title):
         # Some models respond weirdly to this, with a lot of newlines.
         title = title.replace('\n', '')
         title = title[:50]  # Give it some slack, NLPs aren't good at math
         return title
 
-    def prompt_for_introduction(self, game):
-        """Get AIs suggestion for the first sentences, starting the story"""
+    def prompt_for_introduction(self, game, title=None):
+        """Get AIs suggestion for the first sentences, starting the story
+
+        @param title: The title to use, if not the game's current title.
+
+        """
+        if title is None:
+            title = game.title
         prompt = ["Give me three sentences that start this story."]
         # TODO: Change this to the prompt model!
         details = self.remove_internal_comments(game.details).strip()
-        prompt.append(f"The story has the title: '{game.title}'")
+        prompt.append(f"The story has the title: '{title}'")
         if details:
             prompt.append("Important details about the story:")
             prompt.append(details)
         return self.prompt(prompt)
 
-    def prompt_for_next_lines(self, game):
+    def prompt_for_title_and_introduction(self, game):
+        """Get a title and the first sentences for the story, in one prompt.
+
+        Saves a round trip to the NLP when starting a new story. Falls back
+        to asking for them separately, if the response is not valid JSON.
+
+        @rtype: tuple
+        @return: The title and the introduction.
+
+        """
+        prompt = [
+            """Give me a title, max 40 characters, and three sentences that
+            start a story with the given concept. Reply only with JSON, in the
+            format: {"title": "...", "introduction": "..."}""",
+        ]
+        details = self.remove_internal_comments(game.details).strip()
+        if details:
+            prompt.append("The concept of the story:")
+            prompt.append(details)
+        response = self.prompt(prompt, return_raw=True)
+        try:
+            data = json.loads(_RE_JSON_OBJECT.search(response).group())
+            title = self._clean_title(self.clean_text(data["title"]))
+            introduction = self.clean_text(data["introduction"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            logger.debug("Invalid JSON for title and introduction: %r",
+                         response)
+            title = self.prompt_for_title(details)
+            introduction = self.prompt_for_introduction(game, title=title)
+        return title, introduction
+
+    def prompt_for_next_lines(self, game, use_kv_cache=False):
         """Get next few lines from the AI, continuing the story.
 
         @type game: run.Game
         @param game: The game to continue the story from.
 
+        @param use_kv_cache:
+            Let local models reuse the KV-cache from the previous turn, so only
+            the new part of the story has to be encoded.
+
         @rtype: str
         @return: A few sentences, from the AI.
 
         """
-        # TODO: Change this to the prompt model!
-        prompt = ["Generate two more sentences, continuing the given story:"]
-        prompt.append(f"\n---\nThe title of the story: '{game.title}'")
+        return self.prompt(self._get_next_lines_prompt(game),
+                           instructions=game.instructions,
+                           use_kv_cache=use_kv_cache)
+
+    async def astream_next_lines(self, game, use_kv_cache=False):
+        """Get next few lines from the AI, paragraph by paragraph.
+
+        Same as L{prompt_for_next_lines}, but yields each paragraph as soon as
+        the NLP has generated it.
+
+        """
+        text = self._get_next_lines_prompt(game)
+        response = await self._get_prefetched(text, game.instructions)
+        if response is not None:
+            for paragraph in _RE_PARAGRAPH_BREAK.split(response):
+                if paragraph.strip():
+                    yield self.clean_text(paragraph.strip("\n"))
+            return
+        async for paragraph in self.aprompt_stream(
+                text, instructions=game.instructions,
+                use_kv_cache=use_kv_cache):
+            yield paragraph
+
+    def prefetch_next_lines(self, game):
+        """Start generating the next lines in the background, if enabled.
+
+        The response is used by L{astream_next_lines} if the story is still
+        the same when the player asks for more, or else thrown away.
+
+        """
+        if not self.prefetch:
+            return
+        text = self._get_next_lines_prompt(game)
+        instructions = game.instructions
+        future = concurrent.futures.Future()
+
+        def prefetch():
+            try:
+                future.set_result(self.prompt(
+                    text, instructions=instructions, return_raw=True,
+                    use_cache=False))
+            except Exception as e:
+                future.set_exception(e)
+
+        # A daemon thread, so quitting the game doesn't wait for the prompt
+        threading.Thread(target=prefetch, name="prefetch", daemon=True).start()
+        self._prefetched = ((text, instructions), future)
+
+    async def _get_prefetched(self, text, instructions):
+        """Get the prefetched response for the prompt, if any.
+
+        Waits for the prefetch to finish if it's still running. A prefetched
+        response is only used once, so retrying gives a new one.
 
+        """
+        if self._prefetched is None:
+            return None
+        key, future = self._prefetched
+        self._prefetched = None
+        if key != (text, instructions):
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            logger.debug("Prefetch failed, prompting again: %r", e)
+            return None
+
+    def _get_next_lines_prompt(self, game):
+        """Create the prompt for continuing the story"""
+        # TODO: Change this to the prompt model!
         details = self.remove_internal_comments(game.details).strip()
         if details:
-            prompt.append("\n---\nImportant details about the story:")
-            prompt.append(details)
+            details = self.next_lines_details_template.format(details=details)
+        story = game.joined_lines
+        if game.summary_ai:
+            # The summary replaces the start of the story
+            details += self.next_lines_summary_template.format(
+                summary=game.summary_ai)
+            story = "\n".join(game.lines[game.summary_ai_until_line:])
+        return self.next_lines_template.format(
+            title=game.title, details=details, story=story)
+
+    def should_summarize(self, game):
+        """If the story is getting too long for the NLP's input.
+
+        The tokens are estimated at four characters each, which is close
+        enough for English text.
 
-        prompt.append("\n---\n<THE-STORY>:\n")
-        prompt.extend(game.lines)
-        prompt.append("\n\n</THE-STORY>")
-        return self.prompt(prompt, instructions=game.instructions)
+        """
+        if len(game.lines) - game.summary_ai_until_line \
+                <= self.summary_keep_lines:
+            return False
+        max_tokens = game.max_token_input or self.nlp_client.max_tokens_input
+        return len(self._get_next_lines_prompt(game)) / 4 > max_tokens
 
-    def prompt_for_ai_summary(self, game):
+    def prompt_for_ai_summary(self, game, until_line=None):
         """Get a summary of the given story from the AI.
 
         The summary returned is meant to be used in later prompts, to compress
@@ -701,6 +1602,9 @@ class NLPHandler(object):
         @type game: run.Game
         @param game: The game to continue the story from.
 
+        @param until_line:
+            Only summarize the story up to this line. Defaults to all of it.
+
         @rtype: str
         @return: A few sentences, from the AI.
 
@@ -708,10 +1612,10 @@ class NLPHandler(object):
         prompt = ["""Generate a long summary of the given story. Keep important
                   details, and ignore information that is not important to the
                   story. The rest of the prompt contains the story:"""]
-        # TODO: include the summary, if generated, before the next part of the
-        # story, from summary_ai_until_line
         prompt.append(game.summary)
-        prompt.extend(game.lines[game.summary_ai_until_line:])
+        # The previous summary covers the start of the story
+        prompt.append(game.summary_ai)
+        prompt.extend(game.lines[game.summary_ai_until_line:until_line])
         return self.prompt(prompt, instructions=game.instructions)
 
 
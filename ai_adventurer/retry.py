@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Retrying calls to the online AI APIs.
+
+The APIs have rate limits, and respond with HTTP 429 when they are exceeded,
+or 5xx when they are overloaded or have other temporary trouble. The SDKs
+raise their own exceptions for these, so the status code and headers are
+looked up by duck typing.
+
+"""
+
+import functools
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# The HTTP statuses that are worth retrying: rate limited, and the server
+# errors that are usually temporary
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+def get_status_code(error):
+    """Get the HTTP status code from an SDK exception, if any"""
+    # OpenAI and Mistral use `status_code`, Google uses `code`
+    for attr in ("status_code", "code"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def get_retry_wait(error, attempt, max_wait=60, base=1.0):
+    """Get the seconds to wait before retrying a failed request.
+
+    Uses the `Retry-After` header if the API gave it, or else an exponential
+    backoff with some jitter. Never longer than `max_wait`.
+
+    """
+    # OpenAI has `response`, Mistral has `raw_response`
+    for attr in ("response", "raw_response"):
+        response = getattr(error, attr, None)
+        if response is None:
+            continue
+        try:
+            return min(float(response.headers["Retry-After"]), max_wait)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+    backoff = base * 2 ** attempt
+    return min(backoff + random.uniform(0, 0.5 * backoff), max_wait)
+
+
+def with_retry(func, max_retries=5, max_wait=60, retry_on=(),
+               no_retry_on=()):
+    """Wrap the function, retrying it when rate limited or overloaded.
+
+    Other errors, and the last error when giving up, are raised as is.
+
+    @param retry_on:
+        Exception classes to also retry, e.g. connection errors, whatever
+        their status code.
+
+    @param no_retry_on:
+        Exception classes to never retry, even if they are a subclass of
+        `retry_on` or have a status to retry, e.g. timeouts.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if isinstance(e, no_retry_on):
+                    raise
+                status = get_status_code(e)
+                if status not in retry_statuses \
+                        and not isinstance(e, retry_on):
+                    raise
+                if attempt >= max_retries:
+                    raise
+                wait = get_retry_wait(e, attempt, max_wait=max_wait)
+                logger.debug("Got %r, retrying in %.2f seconds...", e, wait)
+                time.sleep(wait)
+    return wrapper
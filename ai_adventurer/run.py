@@ -1,18 +1,24 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import contextlib
 import logging
+import logging.handlers
+import queue
 import re
 
-from ai_adventurer import gui_urwid
 from ai_adventurer import config
-from ai_adventurer import db
 from ai_adventurer import nlp
 
 
 logger = logging.getLogger(__name__)
 
 
+# The indentation of every line
+_RE_INDENT = re.compile(r"^[^\S\n]+", re.MULTILINE)
+
+
 default_details = """
     % Story summary and details.
     %
@@ -33,20 +39,16 @@ def cleanup_text(text):
     """Remove some unnecessary white space"""
     if isinstance(text, (list, tuple)):
         return [cleanup_text(t) for t in text]
-    # Replace multiple newlines with at most two (keeping paragraphs)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    # Replace multiple spaces with a single space
-    text = re.sub(r"[ \t\r\f\v]+", " ", text)
-    return text
+    return nlp._clean_text(text)
 
 
 def clean_text_for_saving(text):
     text = cleanup_text(text)
+    # Like splitting into lines, dropping the newline at the end
+    if text.endswith("\n"):
+        text = text[:-1]
     # Remove white space before comments
-    ret = []
-    for line in text.splitlines():
-        ret.append(line.lstrip())
-    return "\n".join(ret)
+    return _RE_INDENT.sub("", text)
 
 
 class Controller(object):
@@ -55,6 +57,10 @@ class Controller(object):
     def __init__(self, config, secrets):
         self.config = config
         self.secrets = secrets
+        # Imported here, so e.g. listing the models doesn't have to load
+        # sqlalchemy and urwid, which are the slowest imports
+        from ai_adventurer import db
+        from ai_adventurer import gui_urwid
         self.db = db.Database()
         self.gui = gui_urwid.GUI()
 
@@ -83,7 +89,7 @@ class Controller(object):
         }
 
         games = []
-        for game in self.db.get_games():
+        for game in self.db.get_games(with_lines=False):
             game['callback'] = self.load_game
             games.append(game)
         self.gui.load_gamelister(games, choices)
@@ -162,18 +168,24 @@ class Controller(object):
 
     def get_nlp_handler(self):
         modelname = self.config["DEFAULT"]["nlp_model"]
+        cache_dir = self.config["DEFAULT"].get("nlp_cache_dir")
+        prefetch = self.config["DEFAULT"].getboolean("nlp_prefetch")
         try:
-            return nlp.NLPHandler(modelname, secrets=self.secrets)
+            return nlp.NLPHandler(modelname, secrets=self.secrets,
+                                  cache_dir=cache_dir, prefetch=prefetch)
         except nlp.NotAuthenticatedError as e:
             # Ask for API-key and retry
             print(e)
             apikey = input("Input API key: ")
-            keyname = nlp.get_nlp_class(modelname).secrets_api_key_name
+            # The first model, if falling back to others
+            keyname = nlp.get_nlp_class(
+                modelname.split(",")[0]).secrets_api_key_name
             self.secrets['DEFAULT'][keyname] = apikey
             answer = input("Want to save this to secrets.ini? (y/N) ")
             if answer == 'y':
                 config.save_secrets(self.secrets)
-            return nlp.NLPHandler(modelname, secrets=self.secrets)
+            return nlp.NLPHandler(modelname, secrets=self.secrets,
+                                  cache_dir=cache_dir, prefetch=prefetch)
 
 
 class GameController(object):
@@ -213,10 +225,12 @@ class GameController(object):
         concept = cleanup_text(concept).strip()
         if not concept:
             concept = self.nlp.prompt_for_concept()
-        self.game.set_details(concept)
-        title = self.nlp.prompt_for_title(concept)
-        self.game.set_title(title)
-        self.game.add_lines(self.nlp.prompt_for_introduction(self.game))
+        with self.game.batch():
+            self.game.set_details(concept)
+            title, introduction = self.nlp.prompt_for_title_and_introduction(
+                self.game)
+            self.game.set_title(title)
+            self.game.add_lines(introduction)
         self.gui.load_game(self.game, self.game_actions)
 
     def load_game(self):
@@ -225,11 +239,38 @@ class GameController(object):
     def next_line(self, widget):
         """Generate new text"""
         self.gui.send_message("Generating more text...")
-        more = self.nlp.prompt_for_next_lines(self.game)
-        self.game.add_lines(more)
+        asyncio.run(self._stream_next_lines())
         self.gui.story_box.set_selection(-1)
         self.gui.send_message("New text generated")
 
+    async def _stream_next_lines(self):
+        """Add the next part of the story, showing each paragraph as it comes
+
+        """
+        if self.nlp.should_summarize(self.game):
+            # Keep the prompts short, by summarizing the start of the story
+            self.gui.send_message("Summarizing the story so far...")
+            self.gui.redraw()
+            until_line = len(self.game.lines) - self.nlp.summary_keep_lines
+            summary = self.nlp.prompt_for_ai_summary(self.game,
+                                                     until_line=until_line)
+            self.game.set_summary_ai(summary, until_line=until_line)
+        paragraphs = []
+        # Saved once, when the whole part is generated
+        with self.game.batch():
+            async for paragraph in self.nlp.astream_next_lines(
+                    self.game, use_kv_cache=True):
+                paragraphs.append(paragraph)
+                if len(paragraphs) == 1:
+                    self.game.add_lines(paragraph)
+                else:
+                    self.game.change_line(
+                        -1, cleanup_text("\n\n".join(paragraphs)))
+                self.gui.story_box.load_text()
+                self.gui.story_box.set_selection(-1)
+                self.gui.redraw()
+        self.nlp.prefetch_next_lines(self.game)
+
     def retry_line(self, widget):
         """Regenerate chosen line"""
         self.gui.send_message("Retry selected text")
@@ -240,8 +281,7 @@ class GameController(object):
         if selected is None or selected == len(self.game.lines) - 1:
             lineid = len(self.game.lines) - 1
             self.game.delete_line(lineid)
-            more = self.nlp.prompt_for_next_lines(self.game)
-            self.game.add_lines(more)
+            asyncio.run(self._stream_next_lines())
             self.gui.send_message("Part regenerated, if it was the last…")
             self.gui.story_box.load_text()
         else:
@@ -336,6 +376,7 @@ class Game(object):
         self.db = db
 
         self.lines = []
+        self._joined_lines = None
         self.instructions = ""
         self.details = ""
         self.title = "Title"
@@ -345,6 +386,10 @@ class Game(object):
         self.max_token_input = None
         self.max_token_output = None
 
+        # For saving only once after a batch of changes
+        self._batch_depth = 0
+        self._dirty = False
+
         if gameid:
             self.gameid = gameid
             db_game = self.db.get_game(gameid)
@@ -361,8 +406,29 @@ class Game(object):
             self.gameid = db.create_new_game(self.title)
 
     def save(self):
+        """Save the game, or after the batch if in one"""
+        if self._batch_depth:
+            self._dirty = True
+            return
         self.db.save_game(self)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Save the game only once, after all the changes in the block.
+
+        Every change saves the whole game to the database, so a burst of them,
+        e.g. when streaming the next part of the story, is coalesced.
+
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._dirty = False
+                self.save()
+
     def set_instructions(self, text):
         """Set the instructions for the NLP generations."""
         self.instructions = cleanup_text(text)
@@ -381,23 +447,55 @@ class Game(object):
         self.summary = cleanup_text(new_summary).strip()
         self.save()
 
-    def set_summary_ai(self, new_summary):
+    def set_summary_ai(self, new_summary, until_line=None):
+        """Set the AI's summary of the story, up to the given line"""
+        if until_line is None:
+            until_line = len(self.lines)
         self.summary_ai = cleanup_text(new_summary).strip()
-        self.summary_ai_until_line = len(self.lines)
+        self.summary_ai_until_line = until_line
         self.save()
 
+    @property
+    def joined_lines(self):
+        """The whole story as one string, with a newline between the parts.
+
+        Kept up to date when adding lines, so the story is not joined again
+        for every prompt.
+
+        """
+        if self._joined_lines is None:
+            self._joined_lines = "\n".join(self.lines)
+        return self._joined_lines
+
     def add_lines(self, text):
         """Add text to continue the story."""
         text = cleanup_text(text)
+        if self._joined_lines is not None:
+            if self.lines:
+                self._joined_lines += "\n"
+            self._joined_lines += text
         self.lines.append(text)
         self.save()
 
     def delete_line(self, lineid):
+        if lineid < 0:
+            lineid += len(self.lines)
         del self.lines[lineid]
+        self._joined_lines = None
+        if lineid < self.summary_ai_until_line:
+            # Keep pointing at the first line after the summary
+            self.summary_ai_until_line -= 1
         self.save()
 
     def change_line(self, lineid, new_text):
+        if lineid < 0:
+            lineid += len(self.lines)
         self.lines[lineid] = new_text
+        self._joined_lines = None
+        if lineid < self.summary_ai_until_line:
+            # The summary is outdated, so start over with the whole story
+            self.summary_ai = ""
+            self.summary_ai_until_line = 0
         self.save()
 
     def set_max_token_input(self, max_input):
@@ -414,13 +512,34 @@ class Game(object):
         self.details = oldgame.details
         self.title = oldgame.title
         self.summary = oldgame.summary
+        self.summary_ai = oldgame.summary_ai
         self.summary_ai_until_line = oldgame.summary_ai_until_line
-        self.lines = oldgame.lines
+        self.lines = list(oldgame.lines)
+        self._joined_lines = None
         self.max_token_input = oldgame.max_token_input
         self.max_token_output = oldgame.max_token_output
         self.save()
 
 
+def setup_logging(level, filename="logger.log"):
+    """Log to the file from a background thread.
+
+    The game only puts the log records on a queue, so it's not waiting for
+    the disk when debug logging.
+
+    @rtype: logging.handlers.QueueListener
+    @return: The started listener, to be stopped at exit to flush the log.
+
+    """
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(handlers=[logging.handlers.QueueHandler(log_queue)],
+                        level=level)
+    listener = logging.handlers.QueueListener(
+        log_queue, logging.FileHandler(filename, encoding="utf-8"))
+    listener.start()
+    return listener
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Run the AI adventurer game in the terminal"
@@ -459,27 +578,22 @@ def main():
 
     args = parser.parse_args()
 
-    if args.debug:
-        logging.basicConfig(
-            filename="logger.log", encoding="utf-8", level=logging.DEBUG
-        )
-    else:
-        logging.basicConfig(
-            filename="logger.log", encoding="utf-8", level=logging.WARNING
-        )
-
-    if args.list_nlp_models:
-        for m in nlp.nlp_models:
-            print(m)
-        return
-
-    configuration = config.load_config(args.config_file, args)
-    secrets = config.load_secrets(args.secrets_file)
-
-    logger.debug("Starting game")
-    game = Controller(configuration, secrets)
-    game.run()
-    logger.debug("Stopping game")
+    listener = setup_logging(logging.DEBUG if args.debug else logging.WARNING)
+    try:
+        if args.list_nlp_models:
+            for m in nlp.nlp_models:
+                print(m)
+            return
+
+        configuration = config.load_config(args.config_file, args)
+        secrets = config.load_secrets(args.secrets_file)
+
+        logger.debug("Starting game")
+        game = Controller(configuration, secrets)
+        game.run()
+        logger.debug("Stopping game")
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -62,6 +62,21 @@ def test_storybox_empty():
     s.load_text()
 
 
+def test_storybox_selection_is_clamped():
+    game = run.Game(db.MockDatabase())
+    game.add_lines("First")
+    game.add_lines("Second")
+    s = gui_urwid.StoryBox(game, {})
+    assert s.selected_part == 1
+    s.move_selection_down()
+    assert s.selected_part == 1
+    s.move_selection_up()
+    s.move_selection_up()
+    assert s.selected_part == 0
+    s.set_selection(2)
+    assert s.selected_part == 1
+
+
 def test_storybox_oneliner():
     game = run.Game(db.MockDatabase())
     game.add_lines("This is a sentence")
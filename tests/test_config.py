@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import stat
+from unittest import mock
+
+import pytest
 
 from ai_adventurer import config
 
@@ -32,6 +36,25 @@ def test_save_config(tmp_path):
     assert conf == conf2
 
 
+def test_save_config_leaves_no_tmpfile(tmp_path):
+    filename = tmp_path / "conf.ini"
+    config.save_config(config.load_config(""), filename)
+    config.save_config(config.load_config(""), filename)
+    assert os.listdir(tmp_path) == ["conf.ini"]
+
+
+def test_save_config_keeps_no_tmpfile_on_error(tmp_path):
+    filename = tmp_path / "conf.ini"
+    conf = config.load_config("")
+    config.save_config(conf, filename)
+    broken = mock.Mock()
+    broken.write.side_effect = OSError("Disk full")
+    with pytest.raises(OSError):
+        config.save_config(broken, filename)
+    assert os.listdir(tmp_path) == ["conf.ini"]
+    assert config.load_config(filename) == conf
+
+
 def test_save_edited_config(tmp_path):
     filename = tmp_path / "conf.ini"
     conf = config.load_config("")
@@ -75,3 +98,13 @@ def test_save_secrets_without_missing(tmp_path):
     conf3 = config.load_secrets(filename)
     assert 'NEWVALUE' == conf3.get('DEFAULT', 'openai-key')
     assert 'OLDVALUE' not in filename.read_text()
+
+
+def test_save_secrets_permissions(tmp_path):
+    filename = tmp_path / "secrets.ini"
+    conf = config.load_secrets("")
+    config.save_secrets(conf, filename)
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o600
+    os.chmod(filename, 0o640)
+    config.save_secrets(conf, filename)
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o640
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import sqlalchemy
+
 from ai_adventurer import db
 from ai_adventurer import run
 
@@ -117,3 +119,38 @@ def test_game_max_tokens(tmp_path):
     ret = db.get_game(g.gameid)
     assert ret["max_token_input"] == 99
     assert ret["max_token_output"] == 98
+
+
+def test_save_only_changed_lines(tmp_path):
+    db = get_empty_db(tmp_path)
+    g = run.Game(db)
+    for i in range(5):
+        g.add_lines(f"Line {i}.")
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if statement.split()[0] in ("INSERT", "UPDATE", "DELETE"):
+            statements.append(statement)
+
+    sqlalchemy.event.listen(db._engine, "before_cursor_execute", count)
+    g.add_lines("Line 5.")
+    assert len(statements) == 1
+    g.change_line(2, "Changed.")
+    g.delete_line(0)
+    sqlalchemy.event.remove(db._engine, "before_cursor_execute", count)
+
+    assert db.get_lines(g.gameid) == g.lines
+    assert g.lines[1] == "Changed."
+
+
+def test_get_games_without_lines(tmp_path):
+    db = get_empty_db(tmp_path)
+    g = run.Game(db)
+    g.add_lines("One.")
+    g.add_lines("Two.")
+    run.Game(db)
+    games = db.get_games(with_lines=False)
+    assert [game["lenlines"] for game in games] == [2, 0]
+    assert "lines" not in games[0]
+    assert db.get_games()[0]["lines"] == g.lines
@@ -1,5 +1,12 @@
 #!/usr/bin/env python
 
+import asyncio
+import subprocess
+import sys
+import threading
+from unittest import mock
+
+import httpx
 import pytest
 
 from ai_adventurer import nlp
@@ -31,6 +38,28 @@ def test_all_online_models_load_with_fake_auth():
             model(secrets=secrets)
 
 
+def test_import_does_not_load_sdks():
+    # Run in a new interpreter, since other tests load the SDKs
+    code = ("import sys; import ai_adventurer.nlp; "
+            "print(sorted(m for m in ('google.generativeai', 'openai', "
+            "'mistralai', 'torch', 'transformers', 'keras') "
+            "if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_online_clients_share_sdk_client():
+    pytest.importorskip("openai")
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['openai-key'] = 'fake-API-key'
+    first = nlp.OpenAINLPClient(secrets=secrets)
+    second = nlp.OpenAINLPClient(secrets=secrets, modelname="gpt-4o")
+    assert first.client is second.client
+    secrets['DEFAULT']['openai-key'] = 'another-fake-API-key'
+    assert nlp.OpenAINLPClient(secrets=secrets).client is not first.client
+
+
 def test_load_handler():
     nlp.NLPHandler('mock', get_fake_secrets())
 
@@ -70,6 +99,354 @@ def test_base_prompt_with_instructions():
     assert len(ret) > 0
 
 
+def test_prompt_with_kv_cache_unsupported():
+    handler = get_mock_handler()
+    assert not handler.nlp_client.supports_kv_cache
+    ret = handler.prompt("What?", use_kv_cache=True)
+    assert isinstance(ret, str)
+    assert len(ret) > 0
+
+
+class FakeTensor(list):
+    def tolist(self):
+        return list(self)
+
+
+class FakeEncoding(object):
+    def __init__(self, ids):
+        self.input_ids = FakeTensor([FakeTensor(ids)])
+        self.attention_mask = FakeTensor([FakeTensor([1] * len(ids))])
+
+    def to(self, device):
+        return self
+
+
+class FakeTokenizer(object):
+    eos_token_id = 0
+
+    def __init__(self):
+        self.vocab = {}
+
+    def __call__(self, text, return_tensors=None):
+        return FakeEncoding([self.vocab.setdefault(w, len(self.vocab) + 1)
+                             for w in text.split()])
+
+    def decode(self, ids, skip_special_tokens=False):
+        words = {v: k for k, v in self.vocab.items()}
+        return " ".join(words.get(i, "new") for i in ids)
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.cropped_to = None
+
+    def crop(self, max_length):
+        self.cropped_to = max_length
+
+
+class FakeModel(object):
+    device = "cpu"
+
+    def __init__(self):
+        self.given_caches = []
+
+    def generate(self, input_ids, attention_mask=None, past_key_values=None,
+                 **kwargs):
+        assert len(attention_mask[0]) == len(input_ids[0])
+        self.given_caches.append(past_key_values)
+        return mock.Mock(sequences=[FakeTensor(input_ids[0] + [9999])],
+                         past_key_values=FakeCache())
+
+
+class FakeHuggingfaceClient(nlp.HuggingfaceNLPClient):
+    def _load_model(self, modelid):
+        return mock.Mock(tokenizer=FakeTokenizer(), model=FakeModel())
+
+
+def test_kv_cache_reused_for_shared_prefix():
+    client = FakeHuggingfaceClient(extra="fake-model")
+    model = client.model.model
+    assert client.prompt("a b c", use_kv_cache=True) == "new"
+    assert model.given_caches[0] is None
+
+    first_cache = client._past_key_values
+    client.prompt("a b c d e", use_kv_cache=True)
+    assert model.given_caches[1] is first_cache
+    assert first_cache.cropped_to == 3
+
+    # A new prompt with nothing in common should not use the old cache
+    client.prompt("x y", use_kv_cache=True)
+    assert model.given_caches[2] is None
+
+
+def test_huggingface_quantization_from_extra():
+    client = FakeHuggingfaceClient(extra="fake-model:int8")
+    assert client.modelid == "fake-model"
+    assert client.quantization == "int8"
+    client = FakeHuggingfaceClient(extra="fake-model")
+    assert client.modelid == "fake-model"
+    assert client.quantization is None
+    assert client._get_quantization_config() is None
+
+
+def test_local_max_length_is_bucketed():
+    class FakeLocalClient(nlp.LocalNLPClient):
+        def _load_model(self, keras_file):
+            return mock.Mock()
+
+    client = FakeLocalClient(extra="model.keras")
+    assert client._get_max_length(1) == 128
+    assert client._get_max_length(128) == 128
+    assert client._get_max_length(129) == 256
+    assert client._get_max_length(5000) == 1024
+
+
+def test_local_output_is_capped_to_max_tokens():
+    class FakeLocalClient(nlp.LocalNLPClient):
+        def _load_model(self, keras_file):
+            model = mock.Mock()
+            model.generate.side_effect = lambda text, max_length: (
+                text + " word" * max_length)
+            return model
+
+    client = FakeLocalClient(extra="model.keras")
+    output = client.prompt("Once upon a time", max_tokens_output=10)
+    assert output.startswith("word word")
+    assert len(output) <= 10 * 4
+    assert not output.endswith(" ")
+
+
+class FakeLlamaCppClient(nlp.LlamaCppNLPClient):
+    def _load_model(self, model_path):
+        model = mock.Mock()
+        model.side_effect = lambda text, stream=False, max_tokens=None: (
+            iter([{"choices": [{"text": t}]} for t in (" Once", " more")])
+            if stream else {"choices": [{"text": " Once more\n"}]})
+        return model
+
+
+def test_llama_cpp_prompt():
+    client = FakeLlamaCppClient(extra="model.gguf")
+    assert client.prompt("Go", instructions="Be nice") == "Once more"
+    assert client.model.call_args.args == ("Be nice Go",)
+    assert "".join(client.prompt_stream("Go")) == " Once more"
+
+
+def test_vllm_prompt():
+    class FakeVLLMClient(nlp.VLLMNLPClient):
+        def _load_model(self, modelid):
+            model = mock.Mock()
+            output = mock.Mock(text=" Once more\n")
+            model.generate.return_value = [mock.Mock(outputs=[output])]
+            return model
+
+    vllm = mock.Mock()
+    with mock.patch.dict(sys.modules, {"vllm": vllm}):
+        client = FakeVLLMClient(extra="fake-model")
+        assert client.prompt("Go", instructions="Be nice") == "Once more"
+    assert client.model.generate.call_args.args[0] == ["Be nice Go"]
+    assert vllm.SamplingParams.call_args.kwargs["max_tokens"] \
+        == client.max_tokens_output
+
+
+def test_local_model_loads_in_background():
+    release = threading.Event()
+
+    class SlowClient(FakeLlamaCppClient):
+        def _load_model(self, model_path):
+            release.wait(timeout=5)
+            return super()._load_model(model_path)
+
+    client = SlowClient(extra="model.gguf")
+    # Not blocking while loading
+    assert not client._model_loaded.is_set()
+    release.set()
+    assert client.prompt("Go") == "Once more"
+
+
+def test_local_model_load_error_is_raised():
+    class BrokenClient(FakeLlamaCppClient):
+        def _load_model(self, model_path):
+            raise FileNotFoundError(model_path)
+
+    client = BrokenClient(extra="missing.gguf")
+    with pytest.raises(FileNotFoundError):
+        client.prompt("Go")
+
+
+def test_kv_cache_leaves_one_token_to_process():
+    client = FakeHuggingfaceClient(extra="fake-model")
+    client.prompt("a b c", use_kv_cache=True)
+    cache = client._past_key_values
+    client.prompt("a b c", use_kv_cache=True)
+    assert cache.cropped_to == 2
+
+
+def test_aprompt_stream():
+    handler = get_mock_handler()
+
+    async def collect():
+        return [p async for p in handler.aprompt_stream("What?")]
+
+    ret = asyncio.run(collect())
+    assert len(ret) > 0
+    for paragraph in ret:
+        assert isinstance(paragraph, str)
+        assert paragraph.strip()
+
+
+class ChunkedNLPClient(nlp.NLPClient):
+    """Streams its reply in chunks, split at awkward places"""
+
+    chunks = ("First para.\n\n", "\nSecond  para", " end.\n", "\n\n",
+              "Third")
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        yield from self.chunks
+
+
+def test_aprompt_stream_multiple_chunks():
+    handler = get_mock_handler()
+    handler.nlp_client = ChunkedNLPClient(secrets=get_fake_secrets())
+
+    async def collect():
+        return [p async for p in handler.aprompt_stream("What?")]
+
+    ret = asyncio.run(collect())
+    assert ret == ["First para.", "Second para end.", "Third"]
+
+
+def test_openai_prompt_stream():
+    pytest.importorskip("openai")
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['openai-key'] = 'fake-API-key'
+    client = nlp.OpenAINLPClient(secrets=secrets)
+    chunks = []
+    for content in ("Once", " upon", None):
+        chunk = mock.MagicMock()
+        chunk.choices[0].delta.content = content
+        chunks.append(chunk)
+    client.client = mock.MagicMock()
+    client.client.chat.completions.create.return_value = iter(chunks)
+    assert list(client.prompt_stream("Go")) == ["Once", " upon"]
+    kwargs = client.client.chat.completions.create.call_args.kwargs
+    assert kwargs["stream"] is True
+
+
+def test_openai_timeout_is_not_retried():
+    openai = pytest.importorskip("openai")
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['openai-key'] = 'fake-API-key'
+    client = nlp.OpenAINLPClient(secrets=secrets)
+    client.client = mock.MagicMock()
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat")
+    create = client.client.chat.completions.create
+    with mock.patch.object(nlp.retry.time, "sleep") as sleep:
+        create.side_effect = openai.APITimeoutError(request=request)
+        with pytest.raises(openai.APITimeoutError):
+            client.prompt("Go")
+        assert create.call_count == 1
+        assert not sleep.called
+
+        # While other connection errors are
+        create.reset_mock()
+        create.side_effect = openai.APIConnectionError(request=request)
+        with pytest.raises(openai.APIConnectionError):
+            client.prompt("Go")
+        assert create.call_count == client.max_retries + 1
+
+
+def test_prompt_memory_cache():
+    handler = get_mock_handler()
+    handler.memory_cache_size = 2
+    with mock.patch.object(handler.nlp_client, "prompt",
+                           return_value="Cached reply") as prompt:
+        handler.prompt("First")
+        handler.prompt("First")
+        assert prompt.call_count == 1
+        handler.prompt("Second")
+        handler.prompt("Third")
+        assert len(handler.memory_cache) == 2
+        # The oldest is dropped
+        handler.prompt("First")
+        assert prompt.call_count == 4
+        handler.clear_cache()
+        handler.prompt("Third")
+        assert prompt.call_count == 5
+
+
+def test_prompt_memory_cache_expires():
+    handler = get_mock_handler()
+    with mock.patch.object(handler.nlp_client, "prompt",
+                           return_value="Cached reply") as prompt, \
+            mock.patch.object(nlp.time, "monotonic", return_value=1000):
+        handler.prompt("First")
+        handler.prompt("First")
+        assert prompt.call_count == 1
+        nlp.time.monotonic.return_value += handler.memory_cache_expire
+        handler.prompt("First")
+        assert prompt.call_count == 2
+
+
+def test_prompt_disk_cache(tmp_path):
+    pytest.importorskip("diskcache")
+    handler = nlp.NLPHandler("mock", get_fake_secrets(),
+                             cache_dir=str(tmp_path))
+    with mock.patch.object(handler.nlp_client, "prompt",
+                           return_value="Cached reply") as prompt:
+        assert handler.prompt("What?") == "Cached reply"
+        assert handler.prompt("What?") == "Cached reply"
+        assert prompt.call_count == 1
+        handler.prompt("What now?")
+        assert prompt.call_count == 2
+        handler.prompt("What?", use_cache=False)
+        assert prompt.call_count == 3
+
+    # Persisted for new sessions
+    handler = nlp.NLPHandler("mock", get_fake_secrets(),
+                             cache_dir=str(tmp_path))
+    with mock.patch.object(handler.nlp_client, "prompt") as prompt:
+        assert handler.prompt("What?") == "Cached reply"
+        prompt.assert_not_called()
+
+
+def test_gemini_reuses_model():
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['gemini-key'] = 'fake-API-key'
+    client = nlp.GeminiNLPClient(secrets=secrets)
+    client.model_cache_size = 2
+    with mock.patch("google.generativeai.GenerativeModel") as model:
+        client.prompt("Hi", instructions="Be nice")
+        client.prompt("Hi again", instructions="Be nice")
+        assert model.call_count == 1
+        client.prompt("Hi", instructions="Be mean")
+        assert model.call_count == 2
+        client.prompt("Hi", instructions="Be nice", max_tokens_output=10)
+        assert model.call_count == 3
+        assert len(client._model_cache) == 2
+
+
+def test_prompt_with_callback():
+    handler = get_mock_handler()
+    handler.nlp_client = ChunkedNLPClient(secrets=get_fake_secrets())
+    chunks = []
+    ret = handler.prompt("What?", callback=chunks.append)
+    assert chunks == list(ChunkedNLPClient.chunks)
+    assert ret == handler.clean_text("".join(chunks))
+
+
+def test_gemini_prompt_stream():
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['gemini-key'] = 'fake-API-key'
+    client = nlp.GeminiNLPClient(secrets=secrets)
+    chunks = [mock.Mock(text="Once"), mock.Mock(text=" upon")]
+    with mock.patch("google.generativeai.GenerativeModel") as model:
+        model.return_value.generate_content.return_value = iter(chunks)
+        assert list(client.prompt_stream("Go")) == ["Once", " upon"]
+        kwargs = model.return_value.generate_content.call_args.kwargs
+        assert kwargs["stream"] is True
+
+
 def test_get_concept():
     handler = get_mock_handler()
     ret = handler.prompt_for_concept()
@@ -84,6 +461,174 @@ def test_get_title():
     assert len(ret) > 0
 
 
+def test_get_title_and_introduction():
+    handler = get_mock_handler()
+    game = mock.Mock(details="A story about a dragon", title="Title")
+    response = ('```json\n{"title": "The  Dragon",\n'
+                ' "introduction": "You see a dragon."}\n```')
+    with mock.patch.object(handler.nlp_client, "prompt",
+                           return_value=response) as prompt:
+        ret = handler.prompt_for_title_and_introduction(game)
+    assert ret == ("The Dragon", "You see a dragon.")
+    assert prompt.call_count == 1
+
+
+def test_get_title_and_introduction_without_json():
+    handler = get_mock_handler()
+    game = mock.Mock(details="A story about a dragon", title="Title")
+    with mock.patch.object(handler.nlp_client, "prompt",
+                           side_effect=["Not JSON", "A title", "An intro"]):
+        ret = handler.prompt_for_title_and_introduction(game)
+    assert ret == ("A title", "An intro")
+
+
+def test_next_lines_prompt():
+    handler = get_mock_handler()
+    game = mock.Mock(title="The Title", details="% Comment\nSome details",
+                     joined_lines="First line.\nSecond line.", summary_ai="")
+    prompt = handler._get_next_lines_prompt(game)
+    assert isinstance(prompt, str)
+    assert "'The Title'" in prompt
+    assert "Some details" in prompt
+    assert "Comment" not in prompt
+    assert prompt.endswith("First line.\nSecond line.\n\n</THE-STORY>")
+
+    game.details = ""
+    prompt = handler._get_next_lines_prompt(game)
+    assert "Important details" not in prompt
+
+
+def test_next_lines_prompt_with_summary():
+    handler = get_mock_handler()
+    game = mock.Mock(title="The Title", details="", summary_ai="It began.",
+                     lines=["First line.", "Second line."],
+                     summary_ai_until_line=1)
+    prompt = handler._get_next_lines_prompt(game)
+    assert "It began." in prompt
+    assert "First line." not in prompt
+    assert "Second line." in prompt
+
+
+def test_should_summarize():
+    handler = get_mock_handler()
+    handler.summary_keep_lines = 1
+    game = mock.Mock(title="The Title", details="", summary_ai="",
+                     lines=["A line."] * 3, summary_ai_until_line=0,
+                     max_token_input=None)
+    game.joined_lines = "\n".join(game.lines)
+    assert not handler.should_summarize(game)
+    game.max_token_input = 10
+    assert handler.should_summarize(game)
+    # Not when only the lines to keep are left
+    game.summary_ai_until_line = 2
+    assert not handler.should_summarize(game)
+
+
+def test_prefetch_next_lines():
+    handler = get_mock_handler()
+    handler.prefetch = True
+    handler.nlp_client.prompt = mock.Mock(
+        return_value="Prefetched.\n\nSecond  para.")
+    handler.nlp_client.prompt_stream = mock.Mock(return_value=iter(["New."]))
+    game = mock.Mock(title="The Title", details="", summary_ai="",
+                     joined_lines="A line.", instructions="Write")
+
+    async def collect():
+        return [p async for p in handler.astream_next_lines(game)]
+
+    handler.prefetch_next_lines(game)
+    assert asyncio.run(collect()) == ["Prefetched.", "Second para."]
+    assert not handler.nlp_client.prompt_stream.called
+    # Only used once, e.g. not when retrying
+    assert asyncio.run(collect()) == ["New."]
+
+
+def test_prefetch_not_used_for_changed_story():
+    handler = get_mock_handler()
+    handler.prefetch = True
+    handler.nlp_client.prompt = mock.Mock(return_value="Prefetched.")
+    handler.nlp_client.prompt_stream = mock.Mock(return_value=iter(["New."]))
+    game = mock.Mock(title="The Title", details="", summary_ai="",
+                     joined_lines="A line.", instructions="Write")
+
+    async def collect():
+        return [p async for p in handler.astream_next_lines(game)]
+
+    handler.prefetch_next_lines(game)
+    game.joined_lines = "A line.\nAnother line."
+    assert asyncio.run(collect()) == ["New."]
+
+
+def test_prefetch_disabled():
+    handler = get_mock_handler()
+    handler.prefetch_next_lines(mock.Mock())
+    assert handler._prefetched is None
+
+
+def test_prefetch_only_for_online_models():
+    handler = nlp.NLPHandler("mock", get_fake_secrets(), prefetch=True)
+    assert not handler.prefetch
+    pytest.importorskip("openai")
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['openai-key'] = 'fake-API-key'
+    handler = nlp.NLPHandler("gpt-4o-mini,mock", secrets, prefetch=True)
+    assert not handler.prefetch
+    handler = nlp.NLPHandler("gpt-4o-mini", secrets, prefetch=True)
+    assert handler.prefetch
+
+
+class FailingNLPClient(nlp.NLPClient):
+    def prompt(self, text, instructions=None, max_tokens_output=None):
+        raise httpx.ConnectError("Down")
+
+    def prompt_stream(self, text, instructions=None, max_tokens_output=None):
+        raise httpx.ConnectError("Down")
+        yield
+
+
+def test_fallback_models_are_loaded():
+    handler = nlp.NLPHandler("mock,gpt-4o-mini", get_fake_secrets())
+    # Skipping the model without an API key
+    assert isinstance(handler.nlp_client, nlp.FallbackNLPClient)
+    assert len(handler.nlp_client.clients) == 1
+    assert handler.prompt("What?") in nlp.MockNLPClient.replies
+
+    with pytest.raises(nlp.NotAuthenticatedError):
+        nlp.NLPHandler("gpt-4o-mini,gpt-4o", get_fake_secrets())
+
+
+def test_fallback_without_retrying():
+    pytest.importorskip("openai")
+
+    class RateLimited(Exception):
+        status_code = 429
+
+    secrets = get_fake_secrets()
+    secrets['DEFAULT']['openai-key'] = 'fake-API-key'
+    handler = nlp.NLPHandler("gpt-4o-mini,mock", secrets)
+    first, last = handler.nlp_client.clients
+    first.client = mock.MagicMock()
+    first.client.chat.completions.create.side_effect = RateLimited()
+    with mock.patch.object(nlp.retry.time, "sleep") as sleep:
+        assert handler.prompt("What?") in nlp.MockNLPClient.replies
+    assert not sleep.called
+    assert first.client.chat.completions.create.call_count == 1
+
+
+def test_fallback_on_failure():
+    failing = FailingNLPClient(modelname="failing")
+    working = nlp.MockNLPClient(modelname="mock")
+    client = nlp.FallbackNLPClient([failing, working])
+    assert client.prompt("What?") in nlp.MockNLPClient.replies
+    # The failing client is tried last for a while
+    assert client._get_clients() == [working, failing]
+    assert "".join(client.prompt_stream("What?")) in nlp.MockNLPClient.replies
+
+    client = nlp.FallbackNLPClient([failing])
+    with pytest.raises(httpx.ConnectError):
+        client.prompt("What?")
+
+
 def test_prompt_converter_string():
     test = "This is a string"
 
@@ -123,6 +668,58 @@ def test_prompt_converter_dicts():
     ret = client.convert_to_prompt(test)
     assert ret == test
 
+
+def get_mistral_client():
+    pytest.importorskip("mistralai")
+    secrets = get_fake_secrets()
+    secrets['DEFAULT'][nlp.MistralNLP.secrets_api_key_name] = 'fake-API-key'
+    return nlp.MistralNLP(secrets=secrets)
+
+
+def get_mistral_error(status_code, headers=None):
+    import httpx
+    import mistralai
+    return mistralai.models.sdkerror.SDKError(
+        "Requests rate limit exceeded", status_code=status_code,
+        raw_response=httpx.Response(status_code, headers=headers or {}))
+
+
+def test_mistral_retries_rate_limit():
+    client = get_mistral_client()
+    response = mock.MagicMock()
+    response.choices[0].message.content = "A reply"
+    with mock.patch.object(client, "_prompt",
+                           side_effect=[get_mistral_error(429), response]), \
+            mock.patch.object(nlp.time, "sleep") as sleep:
+        assert client.prompt("What?") == "A reply"
+    assert sleep.call_count == 1
+
+
+def test_mistral_gives_up_after_max_retries():
+    client = get_mistral_client()
+    import mistralai
+    errors = [get_mistral_error(429)] * (client.max_retries + 1)
+    with mock.patch.object(client, "_prompt", side_effect=errors), \
+            mock.patch.object(nlp.time, "sleep") as sleep:
+        with pytest.raises(mistralai.models.sdkerror.SDKError):
+            client.prompt("What?")
+    assert sleep.call_count == client.max_retries
+
+
+def test_mistral_prompt_stream():
+    client = get_mistral_client()
+    events = []
+    for content in ("Once", " upon", ""):
+        event = mock.MagicMock()
+        event.data.choices[0].delta.content = content
+        events.append(event)
+    stream = mock.MagicMock()
+    stream.__enter__.return_value = iter(events)
+    with mock.patch.object(client, "_prompt_stream",
+                           side_effect=[get_mistral_error(429), stream]), \
+            mock.patch.object(nlp.time, "sleep"):
+        assert list(client.prompt_stream("Go")) == ["Once", " upon"]
+
 # TODO: test changing the format to the different AI APIs format
 
 # TODO: Test the handler more
@@ -145,3 +742,39 @@ def test_remove_internal_comments_but_keep_anything_else():
     cleaned = handler.remove_internal_comments(prompt)
     assert cleaned == prompt
     assert "now and then" in cleaned
+
+
+def test_remove_internal_comments_indented():
+    handler = get_mock_handler()
+    prompt = ("    % An indented comment\n"
+              "    First line\n"
+              "\t%Another one\n"
+              "\n"
+              "    Second line\n"
+              "% Last comment")
+    cleaned = handler.remove_internal_comments(prompt)
+    assert cleaned == "First line\n\nSecond line"
+
+
+def test_remove_internal_comments_without_comments():
+    handler = get_mock_handler()
+    prompt = "    No comments here\n    but still indented"
+    cleaned = handler.remove_internal_comments(prompt)
+    assert cleaned == "No comments here\nbut still indented"
+    assert handler.remove_internal_comments("") == ""
+
+
+def test_remove_internal_comments_is_cached():
+    handler = get_mock_handler()
+    prompt = "% Comment for the cache test\nText"
+    hits = nlp.NLPHandler.remove_internal_comments.cache_info().hits
+    assert handler.remove_internal_comments(prompt) == "Text"
+    assert handler.remove_internal_comments(prompt) == "Text"
+    info = nlp.NLPHandler.remove_internal_comments.cache_info()
+    assert info.hits == hits + 1
+
+
+def test_clean_text_nested():
+    handler = get_mock_handler()
+    ret = handler.clean_text(["a  b", ["c\t d", "e\n\n\n\nf"]])
+    assert ret == ["a b", ["c d", "e\n\nf"]]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from unittest import mock
+
+import httpx
+import pytest
+
+from ai_adventurer import retry
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = httpx.Response(status_code, headers=headers or {})
+
+
+def test_get_status_code():
+    assert retry.get_status_code(FakeAPIError(429)) == 429
+    error = Exception()
+    error.code = 503
+    assert retry.get_status_code(error) == 503
+    assert retry.get_status_code(Exception()) is None
+
+
+def test_retry_after_is_used_and_capped():
+    error = FakeAPIError(429, headers={"Retry-After": "3"})
+    assert retry.get_retry_wait(error, 0) == 3
+    error = FakeAPIError(429, headers={"Retry-After": "3600"})
+    assert retry.get_retry_wait(error, 0, max_wait=60) == 60
+
+
+def test_backoff_without_retry_after():
+    error = FakeAPIError(429)
+    assert 1 <= retry.get_retry_wait(error, 0) <= 1.5
+    assert 4 <= retry.get_retry_wait(error, 2) <= 6
+    assert retry.get_retry_wait(error, 20, max_wait=60) == 60
+
+
+def test_with_retry_until_success():
+    func = mock.Mock(side_effect=[FakeAPIError(429), FakeAPIError(503),
+                                  "Done"])
+    with mock.patch.object(retry.time, "sleep") as sleep:
+        assert retry.with_retry(func)("arg", key="value") == "Done"
+    assert sleep.call_count == 2
+    func.assert_called_with("arg", key="value")
+
+
+def test_with_retry_gives_up():
+    func = mock.Mock(side_effect=FakeAPIError(429))
+    with mock.patch.object(retry.time, "sleep") as sleep:
+        with pytest.raises(FakeAPIError):
+            retry.with_retry(func, max_retries=3)()
+    assert sleep.call_count == 3
+
+
+def test_with_retry_retry_on():
+    func = mock.Mock(side_effect=[ConnectionError(), "Done"])
+    with mock.patch.object(retry.time, "sleep"):
+        with pytest.raises(ConnectionError):
+            retry.with_retry(func)()
+    func = mock.Mock(side_effect=[ConnectionError(), "Done"])
+    with mock.patch.object(retry.time, "sleep") as sleep:
+        wrapped = retry.with_retry(func, retry_on=(ConnectionError,))
+        assert wrapped() == "Done"
+    assert sleep.call_count == 1
+
+
+def test_with_retry_no_retry_on():
+    class TimeoutError_(ConnectionError):
+        pass
+
+    func = mock.Mock(side_effect=[TimeoutError_(), "Done"])
+    with mock.patch.object(retry.time, "sleep") as sleep:
+        wrapped = retry.with_retry(func, retry_on=(ConnectionError,),
+                                   no_retry_on=(TimeoutError_,))
+        with pytest.raises(TimeoutError_):
+            wrapped()
+    assert not sleep.called
+
+
+def test_with_retry_raises_other_errors():
+    func = mock.Mock(side_effect=[FakeAPIError(400), "Done"])
+    with mock.patch.object(retry.time, "sleep") as sleep:
+        with pytest.raises(FakeAPIError):
+            retry.with_retry(func)()
+    sleep.assert_not_called()
@@ -1,5 +1,10 @@
 #!/usr/bin/env python
 
+import logging
+import subprocess
+import sys
+from unittest import mock
+
 from ai_adventurer import config
 from ai_adventurer import db
 from ai_adventurer import gui_urwid
@@ -7,6 +12,29 @@ from ai_adventurer import nlp
 from ai_adventurer import run
 
 
+def test_cleanup_text():
+    text = "Already clean.\n\nTwo paragraphs."
+    assert run.cleanup_text(text) is text
+    assert run.cleanup_text("a  b\tc\n\n\n\nd") == "a b c\n\nd"
+    assert run.cleanup_text(["a\t b"]) == ["a b"]
+
+
+def test_clean_text_for_saving():
+    text = "\n    % A comment\n    Some text\n\n    More\n"
+    assert run.clean_text_for_saving(text) \
+        == "\n% A comment\nSome text\n\nMore"
+
+
+def test_import_does_not_load_gui_and_db():
+    # Run in a new interpreter, since other tests load them
+    code = ("import sys; import ai_adventurer.run; "
+            "print(sorted(m for m in ('sqlalchemy', 'urwid') "
+            "if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
 # Main controller
 
 def test_controller_load():
@@ -57,6 +85,26 @@ def test_retry_lines():
     assert len(lines) == len(gc.game.lines)
 
 
+def test_next_line():
+    gc = get_mock_gamecontroller()
+    gc.start_new_game_with_concept(None, "Test")
+    lines = gc.game.lines.copy()
+    gc.next_line(None)
+    assert len(gc.game.lines) == len(lines) + 1
+    assert gc.game.lines[-1] in nlp.MockNLPClient.replies
+
+
+def test_next_line_summarizes_long_story():
+    gc = get_mock_gamecontroller()
+    gc.start_new_game_with_concept(None, "Test")
+    gc.nlp.summary_keep_lines = 1
+    gc.game.set_max_token_input(10)
+    gc.next_line(None)
+    gc.next_line(None)
+    assert gc.game.summary_ai
+    assert gc.game.summary_ai_until_line == len(gc.game.lines) - 2
+
+
 def get_empty_db(tmp_path):
     path = f"sqlite:///{tmp_path}/database.sqlite3"
     return db.Database(db_file=path)
@@ -136,6 +184,40 @@ def test_game_object_chunks(tmp_path):
     assert game2.lines == [test_str]
 
 
+def test_game_object_joined_lines(tmp_path):
+    db = get_empty_db(tmp_path)
+    game = run.Game(db=db)
+    assert game.joined_lines == ""
+    game.add_lines("First.")
+    game.add_lines("Second.")
+    assert game.joined_lines == "First.\nSecond."
+    game.change_line(0, "Changed.")
+    assert game.joined_lines == "Changed.\nSecond."
+    game.add_lines("Third.")
+    game.delete_line(1)
+    assert game.joined_lines == "Changed.\nThird."
+
+    game2 = run.Game(db=db, gameid=game.gameid)
+    assert game2.joined_lines == game.joined_lines
+
+
+def test_game_object_batch(tmp_path):
+    db = get_empty_db(tmp_path)
+    game = run.Game(db=db)
+    with mock.patch.object(db, "save_game", wraps=db.save_game) as save:
+        with game.batch():
+            game.set_title("New title")
+            with game.batch():
+                game.add_lines("First.")
+            game.add_lines("Second.")
+            assert not save.called
+        assert save.call_count == 1
+
+    game2 = run.Game(db=db, gameid=game.gameid)
+    assert game2.title == "New title"
+    assert game2.lines == ["First.", "Second."]
+
+
 def test_game_object_summary(tmp_path):
     db = get_empty_db(tmp_path)
     game = run.Game(db=db)
@@ -167,6 +249,34 @@ def test_game_object_summary_ai(tmp_path):
     assert game2.summary_ai_until_line == 2
 
 
+def test_game_object_summary_ai_after_delete(tmp_path):
+    db = get_empty_db(tmp_path)
+    game = run.Game(db=db)
+    for i in range(8):
+        game.add_lines(f"L{i}.")
+    game.set_summary_ai("The start.", until_line=4)
+    game.delete_line(1)
+    assert game.summary_ai_until_line == 3
+    assert game.lines[game.summary_ai_until_line] == "L4."
+    # Not when deleting after the summary
+    game.delete_line(-1)
+    assert game.summary_ai_until_line == 3
+    assert game.summary_ai == "The start."
+
+
+def test_game_object_summary_ai_after_change(tmp_path):
+    db = get_empty_db(tmp_path)
+    game = run.Game(db=db)
+    for i in range(8):
+        game.add_lines(f"L{i}.")
+    game.set_summary_ai("The start.", until_line=4)
+    game.change_line(5, "Changed.")
+    assert game.summary_ai == "The start."
+    game.change_line(2, "Changed.")
+    assert game.summary_ai == ""
+    assert game.summary_ai_until_line == 0
+
+
 def test_game_copy(tmp_path):
     db = get_empty_db(tmp_path)
     game = run.Game(db=db)
@@ -178,6 +288,7 @@ def test_game_copy(tmp_path):
     game.add_lines(test_line)
     details = "Very detailed details"
     game.set_details(details)
+    game.set_summary_ai("A summary", until_line=1)
 
     newgame = run.Game(db=db)
     newgame.copy_from(game)
@@ -188,9 +299,30 @@ def test_game_copy(tmp_path):
     assert newgame.instructions == instruction
     assert newgame.details == details
     assert newgame.lines == game.lines
+    assert newgame.lines is not game.lines
+    assert newgame.summary_ai == "A summary"
+    assert newgame.summary_ai_until_line == 1
 
     newgame2 = run.Game(db=db, gameid=newgame.gameid)
     assert newgame2.title == title
     assert newgame2.instructions == instruction
     assert newgame2.details == details
+    assert newgame2.summary_ai == "A summary"
+    assert newgame2.summary_ai_until_line == 1
     assert newgame2.lines == game.lines
+
+
+def test_setup_logging(tmp_path):
+    root = logging.getLogger()
+    old_handlers, old_level = root.handlers[:], root.level
+    root.handlers.clear()
+    try:
+        listener = run.setup_logging(logging.DEBUG,
+                                     filename=tmp_path / "test.log")
+        logging.getLogger("test").debug("Logged in the background")
+        listener.stop()
+    finally:
+        root.handlers[:] = old_handlers
+        root.setLevel(old_level)
+    log = (tmp_path / "test.log").read_text()
+    assert "DEBUG:test:Logged in the background" in log